@@ -0,0 +1,99 @@
+import asyncio
+import re
+import time
+import uuid
+from typing import Any
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# chat model that replays recorded tool-call sequences instead of calling an API:
+# each script is matched by a phrase of the question and lists, per model call of
+# the turn, either a final answer or a tool call whose arguments may use the
+# output of the previous tool (e.g. the result handle of a query)
+
+
+def handle_of(output: str) -> str:
+    match = re.search(r"Result (r[0-9a-f]+)", output or "")
+    return match.group(1) if match else "missing"
+
+
+def sql(query):
+    return lambda output: ("sql_db_query", {"query": query})
+
+
+def chart(tool, **inputs):
+    return lambda output: (tool, {"inputs": {"result": handle_of(output), **inputs}})
+
+
+def answer(text):
+    return lambda output: text
+
+
+scripts = {
+    "revenue trend": [
+        sql("SELECT year, total_revenue FROM company_data WHERE ticker = 'T0001' AND year BETWEEN 2015 AND 2024 ORDER BY year"),
+        chart("generate_line_plot_wrapper", x="year", y="total_revenue", title="T0001 revenue", xlabel="Year", ylabel="Revenue"),
+        answer("T0001 revenue grew over 2015-2024."),
+    ],
+    "compare margins": [
+        sql("SELECT ticker, year, net_profit_margin FROM company_data WHERE ticker IN ('T0002', 'T0003', 'T0004') AND year >= 2010 ORDER BY ticker, year"),
+        chart("generate_multiline_plot_wrapper", x="year", y=["net_profit_margin"], series="ticker", title="Net profit margin"),
+        answer("T0003 had the highest net profit margin."),
+    ],
+    "largest companies": [
+        sql("SELECT ticker, market_value FROM company_data WHERE year = 2024 ORDER BY market_value DESC LIMIT 8"),
+        chart("generate_bar_plot_wrapper", x="ticker", y="market_value", title="Market value in 2024"),
+        answer("The largest companies by market value in 2024 are shown."),
+    ],
+    "industry breakdown": [
+        sql("SELECT industry_code, SUM(total_revenue) AS revenue FROM company_data WHERE year = 2024 GROUP BY industry_code"),
+        chart("generate_pie_chart_wrapper", x="industry_code", y="revenue", title="Revenue by industry"),
+        answer("Revenue by industry in 2024 is shown."),
+    ],
+    "average growth": [
+        sql("SELECT AVG(revenue_growth) AS growth FROM company_data WHERE year = 2024"),
+        answer("Average revenue growth in 2024 was about 6%."),
+    ],
+    "capital": [
+        answer("Paris."),
+    ],
+}
+
+
+class ScriptedChatModel(BaseChatModel):
+    scripts: dict
+    # seconds each model call takes, standing in for the API round trip
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def next_message(self, messages) -> AIMessage:
+        start = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+        question = messages[start].content.lower()
+        turn = messages[start + 1:]
+        step = sum(isinstance(m, AIMessage) for m in turn)
+        outputs = [m.content for m in turn if isinstance(m, ToolMessage)]
+        script = next((s for phrase, s in self.scripts.items() if phrase in question), [answer("I don't know.")])
+        result = script[min(step, len(script) - 1)](outputs[-1] if outputs else "")
+
+        usage = {"input_tokens": count_tokens_approximately(messages), "output_tokens": 20}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        if isinstance(result, str):
+            return AIMessage(content=result, usage_metadata=usage)
+        name, args = result
+        return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{uuid.uuid4().hex[:12]}"}], usage_metadata=usage)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.next_message(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.next_message(messages))])
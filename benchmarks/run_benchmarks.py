@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+
+# offline end-to-end benchmarks: a synthetic CSV is loaded into the SQLite replica,
+# the agent runs with a scripted model instead of the OpenAI API, and /api/ask is
+# driven in-process at several concurrency levels. Results are written as JSON so
+# runs can be compared across commits.
+#
+#   python benchmarks/run_benchmarks.py --levels 1,4,16 --requests 60
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+src_dir = os.path.join(repo_dir, 'src')
+sys.path[:0] = [bench_dir, src_dir, os.path.join(src_dir, 'data')]
+
+from synthetic_data import make_csv
+from fake_model import ScriptedChatModel, scripts
+
+agent_questions = [
+    'Show the revenue trend of T0001',
+    'Compare margins of T0002, T0003 and T0004',
+    'Which are the largest companies by market value?',
+    'Give me the industry breakdown of revenue',
+    'What was the average growth of revenue in 2024?',
+    'What is the capital of France?',
+]
+fast_path_questions = [
+    "What was T0001's revenue from 2015 to 2024?",
+    'Revenue of T0001, T0002 and T0003 in 2020',
+    'Compare T0005 and T0006 net income since 2010',
+    'T0007 eps in 2024',
+]
+# question -> the years the fast path must answer with, or None when it must pass the
+# question to the agent; 'earliest' and 'latest' are the first and last year in the data
+fast_path_cases = {
+    "Show me T0001's revenue over time": ('earliest', 'latest'),
+    'T0001 revenue trend': ('earliest', 'latest'),
+    'T0001 revenue for each year': ('earliest', 'latest'),
+    'T0001 revenue from 2015': (2015, 'latest'),
+    'T0001 revenue since 2015': (2015, 'latest'),
+    'T0001 revenue until 2020': ('earliest', 2020),
+    'T0001 revenue through 2020': ('earliest', 2020),
+    'T0001 revenue from 2015 to 2020': (2015, 2020),
+    'T0001 revenue in 2020': (2020, 2020),
+    'T0001 revenue': ('latest', 'latest'),
+    'T0001 revenue since': None,
+}
+sql_queries = [
+    "SELECT year, total_revenue FROM company_data WHERE ticker = 'T0001' ORDER BY year",
+    "SELECT ticker, market_value FROM company_data WHERE year = 2024 ORDER BY market_value DESC LIMIT 10",
+    "SELECT industry_code, AVG(net_profit_margin) AS margin FROM company_data WHERE year = 2024 GROUP BY industry_code",
+    "SELECT year, AVG(revenue_growth) AS growth FROM company_data GROUP BY year",
+]
+# queries the QueryGuard must let through on any replica size: their subqueries,
+# compound parts and CTEs read the table once each, not once per row of each other
+guard_accepts = [
+    "SELECT ticker FROM company_data WHERE eps > (SELECT AVG(eps) FROM company_data)",
+    "SELECT ticker FROM company_data WHERE year = 2020 UNION SELECT ticker FROM company_data WHERE year = 2021",
+    "WITH RECURSIVE y(n) AS (SELECT 2015 UNION ALL SELECT n + 1 FROM y WHERE n < 2024) "
+    "SELECT c.ticker, y.n FROM y JOIN company_data c ON c.year = y.n",
+]
+chart_specs = {
+    'line': {'x': list(range(2005, 2025)), 'y': list(np.linspace(100, 400, 20)), 'title': 'Line'},
+    'multiline': {'x': list(range(2005, 2025)), 'y': [list(np.linspace(100, 400, 20)), list(np.linspace(300, 50, 20))], 'labels': ['A', 'B'], 'title': 'Multiline'},
+    'bar': {'x': [f'T{i:04d}' for i in range(10)], 'y': list(np.linspace(10, 100, 10)), 'title': 'Bar'},
+    'pie': {'x': [f'Industry {i}' for i in range(6)], 'y': [5, 10, 15, 20, 25, 25], 'title': 'Pie'},
+}
+
+
+def summarize(samples_ms):
+    samples = np.asarray(samples_ms, dtype=float)
+    if not len(samples):
+        return {'n': 0}
+    return {
+        'n': len(samples),
+        'mean_ms': round(float(samples.mean()), 3),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p95_ms': round(float(np.percentile(samples, 95)), 3),
+        'p99_ms': round(float(np.percentile(samples, 99)), 3),
+        'max_ms': round(float(samples.max()), 3),
+    }
+
+
+def timed(func, reps, before=None):
+    samples = []
+    for _ in range(reps):
+        if before:
+            before()
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return summarize(samples)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir, capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS. RUSAGE_CHILDREN only covers
+    # children that have exited and been waited for, so the chart and Python worker
+    # pools are shut down first
+    import charts
+    import repl
+    charts.pool.shutdown(wait=True)
+    repl.pool.shutdown(wait=True)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'server_process': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20, 1),
+        'largest_child': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20, 1),
+    }
+
+
+def bench_load(csv_path, replica_path, rows):
+    from init_db import read_chunks
+    from init_replica import build_replica
+
+    start = time.perf_counter()
+    parsed = sum(len(chunk) for chunk in read_chunks(csv_path, 50_000))
+    parse_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    build_replica(replica_path, 'csv', csv_path)
+    build_seconds = time.perf_counter() - start
+    return {
+        'csv_rows': rows,
+        'csv_parse_rows_per_s': round(parsed / parse_seconds),
+        'replica_build_seconds': round(build_seconds, 3),
+        'replica_build_rows_per_s': round(rows / build_seconds),
+    }
+
+
+def bench_sql(agent, reps):
+    # the database alone, and the SQL tool with an empty and with a warm result cache
+    def clear():
+        agent.sql_cache.sync_version(object())
+
+    out = {}
+    for i, query in enumerate(sql_queries):
+        out[f'query_{i}'] = {
+            'sql': query,
+            'database': timed(lambda: agent.db._execute(query, fetch='all'), reps),
+            'tool_cold': timed(lambda: agent.query_sql_tool.run(query), reps, before=clear),
+            'tool_cached': timed(lambda: agent.query_sql_tool.run(query), reps),
+        }
+    return out
+
+
+def check_guard(agent):
+    # the cases above that were rejected, with the reason; empty when all pass
+    from sql_tool import QueryRejected
+
+    failures = {}
+    version = agent.dataset_version.current()
+    for query in guard_accepts:
+        try:
+            agent.guard.check(query, version)
+        except QueryRejected as e:
+            failures[query] = str(e)
+    return failures
+
+
+def check_fast_path(fast_path):
+    # the cases above answered with other years, with what the fast path made of them
+    fast_path.directory.refresh()
+    bounds = {'earliest': fast_path.directory.earliest_year, 'latest': fast_path.directory.latest_year}
+    failures = {}
+    for question, expected in fast_path_cases.items():
+        parsed = fast_path.parse(question)
+        got = parsed and (parsed['start'], parsed['end'])
+        if expected is not None:
+            expected = tuple(bounds.get(year, year) for year in expected)
+        if got != expected:
+            failures[question] = {'expected': expected, 'got': got}
+    return failures
+
+
+def bench_charts(reps):
+    from charts import render_chart_sync, pool
+    pool.warm_up()
+    return {kind: timed(lambda: render_chart_sync(kind, spec), reps) for kind, spec in chart_specs.items()}
+
+
+async def bench_api(server, questions, levels, requests_per_level):
+    import httpx
+
+    out = {}
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=120) as client:
+        for level in levels:
+            latencies = []
+            statuses = {}
+            queue = asyncio.Queue()
+            for i in range(requests_per_level):
+                queue.put_nowait(questions[i % len(questions)])
+
+            async def worker():
+                while not queue.empty():
+                    question = queue.get_nowait()
+                    start = time.perf_counter()
+                    # a new session per request, as for first questions from new visitors
+                    response = await client.post('/api/ask', json={'user_input': question}, headers={'X-Session-Id': uuid.uuid4().hex})
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(level)))
+            wall = time.perf_counter() - start
+            out[str(level)] = {
+                **summarize(latencies),
+                'requests_per_s': round(requests_per_level / wall, 2),
+                'status_codes': {str(code): count for code, count in sorted(statuses.items())},
+            }
+            print(f'  concurrency {level}: {out[str(level)]}')
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmarks.')
+    parser.add_argument('--companies', type=int, default=200, help='companies in the synthetic CSV (20 years each)')
+    parser.add_argument('--levels', default='1,4,16', help='comma-separated /api/ask concurrency levels')
+    parser.add_argument('--requests', type=int, default=60, help='/api/ask requests per concurrency level')
+    parser.add_argument('--model-latency', type=float, default=0.0, help='seconds each scripted model call takes')
+    parser.add_argument('--reps', type=int, default=20, help='repetitions of the SQL and chart micro-benchmarks')
+    parser.add_argument('--work-dir', default=None, help='directory for the CSV, replica and charts (default: a temporary one)')
+    parser.add_argument('--out', default=None, help='JSON file to write (default: benchmarks/results/<commit>.json)')
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(',')]
+
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='fin-ai-bench-'))
+    os.makedirs(work_dir, exist_ok=True)
+    csv_path = os.path.join(work_dir, 'synthetic.csv')
+    replica_path = os.path.join(work_dir, 'company_data.sqlite')
+    commit, dirty = git_commit()
+    out = os.path.abspath(args.out or os.path.join(bench_dir, 'results', f"{commit}{'-dirty' if dirty else ''}.json"))
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': vars(args),
+    }
+
+    print('Generating the synthetic CSV and loading it')
+    rows = make_csv(csv_path, companies=args.companies)
+    report['load'] = bench_load(csv_path, replica_path, rows)
+
+    # the app reads its settings at import: point it at the replica, keep charts in
+    # the work dir and turn the answer cache off so every request does the work
+    # (the chart renderer is warmed up by bench_charts instead)
+    os.environ.update({
+        'DB_BACKEND': 'sqlite',
+        'SQLITE_PATH': replica_path,
+        'GRAPH_DIR': os.path.join(work_dir, 'graph'),
+        'OPENAI_API_KEY': 'offline',
+        'ANSWER_CACHE_MAX_ENTRIES': '0',
+        'WARM_UP': '0',
+    })
+    # and away from a developer's .env
+    os.chdir(work_dir)
+
+    import agent
+    import server
+    agent.agent_executor = agent.build_agent(ScriptedChatModel(scripts=scripts, latency=args.model_latency))
+    # the in-process client sends no lifespan events, so load the app here rather
+    # than in the first measured request
+    asyncio.run(server.wait_until_ready())
+
+    print('SQL tool')
+    report['sql_tool'] = bench_sql(agent, args.reps)
+    report['checks'] = {'query_guard': check_guard(agent), 'fast_path': check_fast_path(server.fast_path)}
+    for query, reason in report['checks']['query_guard'].items():
+        print(f'  QueryGuard check failed: {query}\n    {reason}')
+    for question, failure in report['checks']['fast_path'].items():
+        print(f'  fast path check failed: {question!r} {failure}')
+    print('Chart rendering')
+    report['chart_render'] = bench_charts(args.reps)
+
+    print('/api/ask through the agent')
+    server.fast_path_enabled = False
+    report['api_ask'] = {'agent': asyncio.run(bench_api(server, agent_questions, levels, args.requests))}
+    print('/api/ask through the fast path')
+    server.fast_path_enabled = True
+    report['api_ask']['fast_path'] = asyncio.run(bench_api(server, fast_path_questions, levels, args.requests))
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    report['stats'] = asyncio.run(server.stats())
+
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f'Results written to {out}')
+
+
+if __name__ == '__main__':
+    main()
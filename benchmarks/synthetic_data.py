@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from metadata import column_mapping, text_columns, integer_columns
+
+# synthetic company financials in the layout of the source CSV (the abbreviated
+# column names of metadata.column_mapping), so the real loaders can read it
+
+
+def make_csv(path, companies=200, first_year=2005, last_year=2024, seed=0):
+    rng = np.random.default_rng(seed)
+    years = np.arange(first_year, last_year + 1)
+    n = companies * len(years)
+    company = np.repeat(np.arange(companies), len(years))
+
+    # a revenue path per company, with the other amounts as noisy fractions of it
+    growth = rng.normal(0.06, 0.15, size=n).reshape(companies, len(years))
+    revenue = (rng.lognormal(7, 1.5, size=companies)[:, None] * np.cumprod(1 + growth, axis=1)).ravel()
+
+    def share(low, high):
+        return revenue * rng.uniform(low, high, size=n)
+
+    df = pd.DataFrame({col: share(0.01, 1.5) for col in column_mapping if col not in text_columns + integer_columns})
+    df['revt'] = revenue
+    df['gp'] = share(0.2, 0.6)
+    df['ni'] = share(-0.1, 0.25)
+    df['ebit'] = share(0.0, 0.3)
+    df['ebitda'] = df['ebit'] * 1.2
+    df['csho'] = rng.uniform(50, 5000, size=n)
+    df['epsfx'] = df['ni'] / df['csho']
+    df['dvpsx_f'] = np.abs(df['epsfx']) * rng.uniform(0, 0.5, size=n)
+    df['prcc_f'] = np.abs(df['epsfx']) * rng.uniform(5, 40, size=n)
+    df['mkvalt'] = df['prcc_f'] * df['csho']
+
+    df['gvkey'] = 1000 + company
+    df['tic'] = [f'T{i:04d}' for i in company]
+    df['conm'] = [f'COMPANY{i:04d} INC' for i in company]
+    df['gind'] = 100000 + (company % 12) * 1010
+    df['loc'] = np.where(company % 5 == 0, 'CAN', 'USA')
+    df['fyear'] = np.tile(years, companies)
+    df = df[list(column_mapping)]
+    # some missing values, as in the real data
+    numeric = [col for col in column_mapping if col not in text_columns + integer_columns]
+    mask = rng.random((n, len(numeric))) < 0.02
+    df[numeric] = df[numeric].mask(mask)
+    df.to_csv(path, index=False)
+    return n
@@ -1,199 +1,267 @@
 import os
+import time
 from langchain.chat_models import init_chat_model
 from langchain_community.utilities import SQLDatabase
-from langchain_community.tools import QuerySQLDatabaseTool
-from langchain_experimental.utilities import PythonREPL
-from langchain_core.tools import Tool, StructuredTool
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.tools import StructuredTool
 from langgraph.prebuilt import create_react_agent
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
 from dotenv import load_dotenv
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-import matplotlib
 from pydantic import BaseModel
 from typing import List, Optional
-
-# Load environment variables
-assert load_dotenv('.env') or load_dotenv('../.env')
+from sqlalchemy.exc import DBAPIError
+from checkpointer import create_checkpointer, checkpoint_durability
+from context import trim_context, add_usage, new_usage
+from cache import TTLCache
+from database import DatasetVersion, mysql_engine
+from sql_tool import CachedQuerySQLDatabaseTool, QueryGuard
+from charts import render_chart, render_chart_sync, ChartRenderError, chart_format, chart_dpi, chart_size
+from graph_store import graph_store
+from repl import run_code, run_code_sync, ReplError
+from replica import ensure_replica, replica_engine
+from telemetry import span, request_callbacks
+from results import ResultStore, series_data, multi_series_data
+
+# Load environment variables (settings may also come from the environment alone)
+load_dotenv('.env') or load_dotenv('../.env')
 openai_api_key = os.getenv("OPENAI_API_KEY")
-model = init_chat_model(os.getenv("OPENAI_MODEL_NAME","gpt-4o-mini"), model_provider="openai", max_tokens=2000, temperature=0.3)
-memory = MemorySaver()
-matplotlib.use('Agg')
-
-try:
-    db_uri = f'mysql+mysqlconnector://{os.getenv("MYSQL_USER",'root')}:{os.getenv("MYSQL_PASSWORD",'password')}@{os.getenv("MYSQL_HOST",'localhost')}:{os.getenv("MYSQL_PORT",3306)}/financial_db'
-    db = SQLDatabase.from_uri(db_uri)
-    query_sql_tool = QuerySQLDatabaseTool(db=db)
-except Exception as e:
-    print(f'Could not connect to MySQL DB. Check DB_URI or make sure server is running. Error: {e}')
-    exit(1)
-
-repl_tool = Tool(
+model = init_chat_model(os.getenv("OPENAI_MODEL_NAME","gpt-4o-mini"), model_provider="openai", max_tokens=2000, temperature=0.3, stream_usage=True)
+
+# mysql, or sqlite for the embedded read-only replica of company_data (see replica.py)
+db_backend = os.getenv("DB_BACKEND", "mysql").lower()
+dialect = "SQLite" if db_backend == "sqlite" else "MySQL"
+
+# the database may still be starting when the server does (containers brought up
+# together), so connecting is retried with exponential backoff
+db_connect_attempts = int(os.getenv("DB_CONNECT_ATTEMPTS", 8))
+db_connect_backoff = float(os.getenv("DB_CONNECT_BACKOFF_SECONDS", 0.5))
+
+
+def connect_database(engine):
+    delay = db_connect_backoff
+    for attempt in range(1, db_connect_attempts + 1):
+        try:
+            # only company_data is exposed, and its schema is reflected on first use
+            # rather than at startup (the agent gets the schema from the system prompt)
+            return SQLDatabase(engine, include_tables=["company_data"], lazy_table_reflection=True)
+        except DBAPIError as e:
+            if attempt == db_connect_attempts:
+                print(f'Could not connect to {dialect} DB. Check DB_URI or make sure server is running. Error: {e}')
+                raise
+            print(f'Could not connect to {dialect} DB (attempt {attempt} of {db_connect_attempts}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
+
+if db_backend == "sqlite":
+    ensure_replica()
+    engine = replica_engine()
+else:
+    engine = mysql_engine()
+db = connect_database(engine)
+# after the database is reachable, as the checkpointer may keep conversations in it
+memory = create_checkpointer()
+dataset_version = DatasetVersion(db, check_interval=float(os.getenv("DATASET_VERSION_CHECK_SECONDS", 30)))
+sql_cache = TTLCache(
+    max_entries=int(os.getenv("SQL_CACHE_MAX_ENTRIES", 1000)),
+    max_bytes=int(os.getenv("SQL_CACHE_MAX_BYTES", 20_000_000)),
+    ttl=float(os.getenv("SQL_CACHE_TTL_SECONDS", 3600)),
+)
+results = ResultStore(
+    sql_cache,
+    preview_rows=int(os.getenv("RESULT_PREVIEW_ROWS", 10)),
+    max_cell_chars=int(os.getenv("RESULT_PREVIEW_CELL_CHARS", 100)),
+)
+guard = QueryGuard(
+    db,
+    max_rows=int(os.getenv("SQL_MAX_ROWS", 1000)),
+    max_scan_rows=int(os.getenv("SQL_MAX_SCAN_ROWS", 5_000_000)),
+)
+query_sql_tool = CachedQuerySQLDatabaseTool(db=db, results=results, dataset_version=dataset_version, guard=guard)
+
+# python_repl runs code in the worker pool of repl.py, with query results passed in
+# as DataFrames under their handles
+class ReplInput(BaseModel):
+    code: str
+    results: List[str] = []
+
+def repl_frames(inputs: ReplInput) -> dict:
+    frames = {}
+    for handle in inputs.results:
+        df = results.get(handle)
+        if df is None:
+            raise ValueError(f"no query result with handle '{handle}', run the query again")
+        frames[handle] = df
+    return frames
+
+def run_python(inputs: ReplInput):
+    try:
+        return run_code_sync(inputs.code, repl_frames(inputs))
+    except (ValueError, ReplError) as e:
+        return f"Error: {e}"
+
+async def arun_python(inputs: ReplInput):
+    try:
+        return await run_code(inputs.code, repl_frames(inputs))
+    except (ValueError, ReplError) as e:
+        return f"Error: {e}"
+
+repl_tool = StructuredTool.from_function(
+    func=run_python,
+    coroutine=arun_python,
     name="python_repl",
-    description="A Python shell. Use this to execute python commands. Input should be a valid python command. If you want to see the output of a value, you should print it out with print(...).",
-    func=PythonREPL().run,
+    input_schema=ReplInput,
+    description=(
+        "A Python shell with pandas (pd) and NumPy (np) for calculations on query results. "
+        "Required keys: 'code' (Python code; print(...) the values you want to see). "
+        "Optional: 'results' (list of query result handles; each is available as a DataFrame under its handle, and as `df` when there is one). "
+        "Every run starts with a fresh namespace, and runs are limited in time and memory."
+    ),
 )
 
+# the chart tools take the handle of a query result and column names; the values
+# are read from the result store rather than written out by the model
 class PlotInput(BaseModel):
-    x: List[int|str]
-    y: List[float]
-    graph_folder: str
-    filename: str
+    result: str
+    x: str
+    y: str
     title: Optional[str] = "Plot"
     xlabel: Optional[str] = "X"
     ylabel: Optional[str] = "Y"
 
 class MultiPlotInput(BaseModel):
-    x: List[int|str]
-    y: List[List[float]]
-    labels: List[str]
-    graph_folder: str
-    filename: str
+    result: str
+    x: str
+    y: List[str]
+    series: Optional[str] = None
     title: Optional[str] = "Plot"
     xlabel: Optional[str] = "X"
     ylabel: Optional[str] = "Y"
 
-def generate_line_plot(x, y, graph_folder, filename, title="Line Plot", xlabel="X", ylabel="Y"):
-    dir = os.path.dirname(graph_folder)
-    if dir and not os.path.exists(dir):
-        os.makedirs(dir)
-
-    plt.figure()
-    plt.plot(x, y, marker="o")
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.grid(True)
-
-    ax = plt.gca()
-    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
-
-    plt.tight_layout()
-
-    path = os.path.join(graph_folder, filename)
-    plt.savefig(path)
-    plt.close()
-
-def generate_multiline_plot(x, y, graph_folder, filename, title="Multiline Plot", xlabel="X", ylabel="Y", labels=None):
-    dir = os.path.dirname(graph_folder)
-    if dir and not os.path.exists(dir):
-        os.makedirs(dir)
-
-    plt.figure()
-    for i, y_values in enumerate(y):
-        plt.plot(x, y_values, marker="o", label=labels[i])
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.legend()
-    plt.grid(True)
-
-    ax = plt.gca()
-    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
-
-    plt.tight_layout()
-
-    path = os.path.join(graph_folder, filename)
-    plt.savefig(path)
-    plt.close()
-
-def generate_bar_plot(x, y, graph_folder, filename, title="Bar Plot", xlabel="X", ylabel="Y"):
-    dir = os.path.dirname(graph_folder)
-    if dir and not os.path.exists(dir):
-        os.makedirs(dir)
-
-    plt.figure()
-    plt.bar(x, y)
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.xticks(rotation=45,ha='right')
-    plt.grid(axis='y')
-
-    plt.tight_layout()
-
-    path = os.path.join(graph_folder, filename)
-    plt.savefig(path)
-    plt.close()
-
-def generate_pie_chart(x, y, graph_folder, filename, title="Pie Chart"):
-    dir = os.path.dirname(graph_folder)
-    if dir and not os.path.exists(dir):
-        os.makedirs(dir)
-
-    plt.figure(figsize=(8, 5))
-    
-    plt.pie(y, labels=x, autopct='%1.1f%%', startangle=140)
-    plt.title(title)
-    plt.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-
-    plt.tight_layout()
-
-    path = os.path.join(graph_folder, filename)
-    plt.savefig(path)
-    plt.close()
-
-def generate_line_plot_wrapper(inputs: PlotInput) -> str:
-    generate_line_plot(inputs.x, inputs.y, inputs.graph_folder, inputs.filename, inputs.title, inputs.xlabel, inputs.ylabel)
-    return f"Graph generated: {inputs.graph_folder}/{inputs.filename}"
-
-def generate_multiline_plot_wrapper(inputs: MultiPlotInput) -> str:
-    generate_multiline_plot(inputs.x, inputs.y, inputs.graph_folder, inputs.filename, inputs.title, inputs.xlabel, inputs.ylabel, inputs.labels)
-    return f"Graph generated: {inputs.graph_folder}/{inputs.filename}"
-
-def generate_bar_plot_wrapper(inputs: PlotInput) -> str:
-    generate_bar_plot(inputs.x, inputs.y, inputs.graph_folder, inputs.filename, inputs.title, inputs.xlabel, inputs.ylabel)
-    return f"Graph generated: {inputs.graph_folder}/{inputs.filename}"
-
-def generate_pie_chart_wrapper(inputs: PlotInput) -> str:
-    generate_pie_chart(inputs.x, inputs.y, inputs.graph_folder, inputs.filename, inputs.title)
-    return f"Graph generated: {inputs.graph_folder}/{inputs.filename}"
+# charts go to the content-addressed graph store; the tool result carries the
+# chart's URL as its artifact, which the server picks up from the ToolMessage
+def chart_name(kind: str, spec: dict) -> str:
+    return graph_store.name_for(kind, spec, chart_format, chart_dpi, chart_size)
+
+def chart_spec(kind: str, inputs) -> dict:
+    df = results.get(inputs.result)
+    if df is None:
+        raise ValueError(f"no query result with handle '{inputs.result}', run the query again")
+    if kind == "multiline":
+        data = multi_series_data(df, inputs.x, inputs.y, inputs.series)
+    else:
+        data = series_data(df, inputs.x, inputs.y)
+    return {**data, "title": inputs.title, "xlabel": inputs.xlabel, "ylabel": inputs.ylabel}
+
+def draw_chart(kind: str, inputs):
+    try:
+        spec = chart_spec(kind, inputs)
+    except ValueError as e:
+        return f"Error: {e}", None
+    name = chart_name(kind, spec)
+    if not graph_store.contains(name):
+        try:
+            with span("chart_render", kind=kind):
+                data = render_chart_sync(kind, spec)
+            graph_store.put(name, data)
+        except ChartRenderError as e:
+            return f"Error: {e}", None
+    return "Graph generated.", {"graph_url": f"graph/{name}"}
+
+async def adraw_chart(kind: str, inputs):
+    try:
+        spec = chart_spec(kind, inputs)
+    except ValueError as e:
+        return f"Error: {e}", None
+    name = chart_name(kind, spec)
+    if not graph_store.contains(name):
+        try:
+            with span("chart_render", kind=kind):
+                data = await render_chart(kind, spec)
+            graph_store.put(name, data)
+        except ChartRenderError as e:
+            return f"Error: {e}", None
+    return "Graph generated.", {"graph_url": f"graph/{name}"}
+
+def graph_url_of(message) -> Optional[str]:
+    if isinstance(message, ToolMessage) and isinstance(message.artifact, dict):
+        return message.artifact.get("graph_url")
+    return None
+
+def generate_line_plot_wrapper(inputs: PlotInput):
+    return draw_chart("line", inputs)
+
+async def agenerate_line_plot_wrapper(inputs: PlotInput):
+    return await adraw_chart("line", inputs)
+
+def generate_multiline_plot_wrapper(inputs: MultiPlotInput):
+    return draw_chart("multiline", inputs)
+
+async def agenerate_multiline_plot_wrapper(inputs: MultiPlotInput):
+    return await adraw_chart("multiline", inputs)
+
+def generate_bar_plot_wrapper(inputs: PlotInput):
+    return draw_chart("bar", inputs)
+
+async def agenerate_bar_plot_wrapper(inputs: PlotInput):
+    return await adraw_chart("bar", inputs)
+
+def generate_pie_chart_wrapper(inputs: PlotInput):
+    return draw_chart("pie", inputs)
+
+async def agenerate_pie_chart_wrapper(inputs: PlotInput):
+    return await adraw_chart("pie", inputs)
 
 graph_line_plot_tool = StructuredTool.from_function(
     func=generate_line_plot_wrapper,
+    coroutine=agenerate_line_plot_wrapper,
     input_schema=PlotInput,
+    response_format="content_and_artifact",
     description=(
         "Use this tool to generate line plots. "
-        "Required keys: 'x' (list of x values), 'y' (list of y values), 'graph_folder' (folder to save graph in)."
-        "Optional: 'filename', 'title (title of the figure)', 'xlabel (name of horizontal axis)', 'ylabel (name of vertical axis)'."
+        "Required keys: 'result' (handle of a query result), 'x' (column with the x values), 'y' (column with the y values). "
+        "Optional: 'title (title of the figure)', 'xlabel (name of horizontal axis)', 'ylabel (name of vertical axis)'."
     )
 )
 
 graph_multiline_plot_tool = StructuredTool.from_function(
     func=generate_multiline_plot_wrapper,
+    coroutine=agenerate_multiline_plot_wrapper,
     input_schema=MultiPlotInput,
+    response_format="content_and_artifact",
     description=(
         "Use this tool to generate line plots for M multiple datasets. "
-        "Required keys: 'x' (list of x-values), 'y' (nested list of y-values), 's' (list of M labels), 'graph_folder' (folder to save graph in)."
-        "Optional: 'filename', 'title (title of the figure)', 'xlabel (name of horizontal axis)', 'ylabel (name of vertical axis)'."
+        "Required keys: 'result' (handle of a query result), 'x' (column with the x values), 'y' (list of value columns, one line each). "
+        "Or give a single 'y' column and 'series' (column whose values name the lines, e.g. ticker) for results with one row per line and x value. "
+        "Optional: 'title (title of the figure)', 'xlabel (name of horizontal axis)', 'ylabel (name of vertical axis)'."
     )
 )
 
 graph_bar_plot_tool = StructuredTool.from_function(
     func=generate_bar_plot_wrapper,
+    coroutine=agenerate_bar_plot_wrapper,
     input_schema=PlotInput,
+    response_format="content_and_artifact",
     description=(
         "Use this tool to generate bar plots."
-        "Required keys: 'x' (list of x values), 'y' (list of y values), 'graph_folder' (folder to save graph in)."
-        "Optional: 'filename', 'title (title of the figure)', 'xlabel (name of horizontal axis)', 'ylabel (name of vertical axis)'."
+        "Required keys: 'result' (handle of a query result), 'x' (column with the x values), 'y' (column with the y values). "
+        "Optional: 'title (title of the figure)', 'xlabel (name of horizontal axis)', 'ylabel (name of vertical axis)'."
     )
 )
 
 graph_pie_chart_tool = StructuredTool.from_function(
     func=generate_pie_chart_wrapper,
+    coroutine=agenerate_pie_chart_wrapper,
     input_schema=PlotInput,
+    response_format="content_and_artifact",
     description=(
         "Use this tool to generate pie charts."
-        "Required keys: 'x' (list of labels), 'y' (list of values), 'graph_folder' (folder to save graph in)."
-        "Optional: 'filename', 'title (title of the figure)'."
+        "Required keys: 'result' (handle of a query result), 'x' (column with the labels), 'y' (column with the values). "
+        "Optional: 'title (title of the figure)'."
     )
 )
 
 tools = [repl_tool, query_sql_tool, graph_line_plot_tool, graph_multiline_plot_tool, graph_bar_plot_tool, graph_pie_chart_tool]
 
-agent_executor = create_react_agent(model, tools, checkpointer=memory)
-
 db_description = """
 The finanal_db database has one main table: `company_data`, with the following structure:
 
@@ -295,24 +363,88 @@ use the following tools available to generate a relevant chart.
 3. `graph_bar_plot_tool`: Use this if the question is about different companies in a specific year.
 4. `graph_pie_chart_tool`: Use this if the question is about the breakdown of a quantity into different aspects.
 
+The query tool returns a preview of the result and a handle such as r1a2b3c4d. To chart a result, pass its handle
+and column names to a chart tool; never copy the values into the chart tool call.
+For calculations on a result that SQL can't do easily, pass its handle to python_repl, where it is a pandas DataFrame.
+
+The chart is shown to the user automatically; do not mention the chart being saved or generated, or where it is stored.
+
 If the query result has 3 to 10 data points, return a text-based answer in addition to the graph. 
 If the query result has more than 10 data points, return only the graph and do NOT return the raw values in text.
 
 """.format(
-    dialect="MySQL",
+    dialect=dialect,
     top_k=5,
     db_description=db_description
 ))
 
-def query_agent(user_input: str):
+# the system prompt is prepended on every model call instead of being stored in the
+# conversation, and trim_context keeps the history it is sent with within budget
+def build_agent(chat_model):
+    return create_react_agent(chat_model, tools, checkpointer=memory, prompt=system_message, pre_model_hook=trim_context)
+
+agent_executor = build_agent(model)
+
+def query_agent(user_input: str, thread_id: str = "thread-001"):
     user_message = HumanMessage(content=user_input)
-    config = {"configurable": {"thread_id": "thread-001"}}
+    config = {"configurable": {"thread_id": thread_id}}
     full_response = ""
 
-    for step in agent_executor.stream({"messages": [system_message, user_message]}, config, stream_mode="values"):
-        if step["messages"]:
-            step["messages"][-1].pretty_print()
+    for step in agent_executor.stream({"messages": [user_message]}, config, stream_mode="values", durability=checkpoint_durability):
         if step["messages"] and isinstance(step["messages"][-1], AIMessage):
             chunk = step["messages"][-1].content
             full_response += chunk
     return full_response
+
+async def aquery_agent(user_input: str, thread_id: str):
+    # async counterpart of query_agent: model calls await on the event loop and
+    # the synchronous tools are dispatched to the default thread pool by the ToolNode
+    user_message = HumanMessage(content=user_input)
+    config = {"configurable": {"thread_id": thread_id}, "callbacks": request_callbacks()}
+    full_response = ""
+    usage = new_usage()
+    graph_url = None
+
+    async for step in agent_executor.astream({"messages": [user_message]}, config, stream_mode="values", durability=checkpoint_durability):
+        if step["messages"]:
+            graph_url = graph_url_of(step["messages"][-1]) or graph_url
+        if step["messages"] and isinstance(step["messages"][-1], AIMessage):
+            chunk = step["messages"][-1].content
+            full_response += chunk
+            add_usage(usage, step["messages"][-1])
+    return {"response": full_response, "usage": usage, "graph_url": graph_url}
+
+async def astream_agent(user_input: str, thread_id: str):
+    # yields incremental events for one turn: model token deltas while the model is
+    # writing, a tool_start/tool_end pair around every tool call and the turn's token
+    # usage at the end
+    user_message = HumanMessage(content=user_input)
+    config = {"configurable": {"thread_id": thread_id}, "callbacks": request_callbacks()}
+    usage = new_usage()
+
+    async for mode, chunk in agent_executor.astream({"messages": [user_message]}, config, stream_mode=["messages", "updates"], durability=checkpoint_durability):
+        if mode == "messages":
+            message, metadata = chunk
+            # AIMessageChunk (a subclass) when the model streams, a whole AIMessage otherwise
+            if isinstance(message, AIMessage) and metadata.get("langgraph_node") == "agent" and message.content:
+                yield {"event": "token", "text": message.content}
+        elif mode == "updates":
+            for update in chunk.values():
+                for message in (update or {}).get("messages", []):
+                    if isinstance(message, AIMessage):
+                        add_usage(usage, message)
+                        for call in message.tool_calls:
+                            yield {"event": "tool_start", "id": call["id"], "tool": call["name"]}
+                    elif isinstance(message, ToolMessage):
+                        yield {"event": "tool_end", "id": message.tool_call_id, "tool": message.name, "status": message.status, "graph_url": graph_url_of(message)}
+    yield {"event": "usage", **usage}
+
+async def thread_is_new(thread_id: str) -> bool:
+    state = await agent_executor.aget_state({"configurable": {"thread_id": thread_id}})
+    return not state.values.get("messages")
+
+async def record_turn(thread_id: str, question: str, answer: str):
+    # store a turn answered without running the agent (e.g. from the answer cache)
+    # so follow-up questions in the same session still see it
+    config = {"configurable": {"thread_id": thread_id}}
+    await agent_executor.aupdate_state(config, {"messages": [HumanMessage(content=question), AIMessage(content=answer)]}, as_node="agent")
@@ -0,0 +1,102 @@
+import io
+import os
+from workers import WorkerPool
+
+# chart rendering engine: figures are drawn with matplotlib's object-oriented API
+# (Figure + FigureCanvasAgg, no pyplot global state) inside a pool of worker
+# processes that import matplotlib once when they start, so charts for concurrent
+# requests render in parallel across cores without touching each other
+
+chart_format = os.getenv("CHART_FORMAT", "png").lower()  # png, svg or webp
+chart_dpi = int(os.getenv("CHART_DPI", 100))
+chart_size = (float(os.getenv("CHART_WIDTH", 6.4)), float(os.getenv("CHART_HEIGHT", 4.8)))
+pie_chart_size = (8, 5)
+render_timeout = float(os.getenv("CHART_RENDER_TIMEOUT_SECONDS", 10))
+render_workers = int(os.getenv("CHART_WORKERS", min(4, os.cpu_count() or 1)))
+
+
+class ChartRenderError(Exception):
+    pass
+
+
+def draw_line(ax, spec):
+    from matplotlib.ticker import MaxNLocator
+    ax.plot(spec["x"], spec["y"], marker="o")
+    ax.grid(True)
+    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+
+
+def draw_multiline(ax, spec):
+    from matplotlib.ticker import MaxNLocator
+    for y_values, label in zip(spec["y"], spec["labels"]):
+        ax.plot(spec["x"], y_values, marker="o", label=label)
+    ax.legend()
+    ax.grid(True)
+    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+
+
+def draw_bar(ax, spec):
+    ax.bar(spec["x"], spec["y"])
+    ax.tick_params(axis="x", labelrotation=45)
+    for label in ax.get_xticklabels():
+        label.set_horizontalalignment("right")
+    ax.grid(axis="y")
+
+
+def draw_pie(ax, spec):
+    ax.pie(spec["y"], labels=spec["x"], autopct='%1.1f%%', startangle=140)
+    ax.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+
+
+drawers = {
+    "line": draw_line,
+    "multiline": draw_multiline,
+    "bar": draw_bar,
+    "pie": draw_pie,
+}
+
+
+def render(kind, spec, fmt, dpi, size):
+    # runs inside a worker process; returns the encoded image
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=pie_chart_size if kind == "pie" else size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    drawers[kind](ax, spec)
+    ax.set_title(spec.get("title", ""))
+    if kind != "pie":
+        ax.set_xlabel(spec.get("xlabel", ""))
+        ax.set_ylabel(spec.get("ylabel", ""))
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def warm_worker():
+    # process initializer: pay for the matplotlib import, font cache and first draw
+    # before the worker takes real requests
+    import matplotlib
+    matplotlib.use("Agg")
+    render("line", {"x": [0, 1], "y": [0, 1]}, chart_format, 10, (1, 1))
+
+
+pool = WorkerPool(
+    render_workers,
+    render_timeout,
+    ChartRenderError,
+    initializer=warm_worker,
+    timeout_message=f"rendering the chart took longer than {render_timeout}s and was stopped",
+    crash_message="the chart renderer crashed, try again",
+)
+
+
+async def render_chart(kind: str, spec: dict) -> bytes:
+    return await pool.acall(render, kind, spec, chart_format, chart_dpi, chart_size)
+
+
+def render_chart_sync(kind: str, spec: dict) -> bytes:
+    return pool.call(render, kind, spec, chart_format, chart_dpi, chart_size)
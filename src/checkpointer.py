@@ -0,0 +1,452 @@
+import asyncio
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP, get_checkpoint_id, get_checkpoint_metadata
+from langgraph.checkpoint.memory import MemorySaver
+from sqlalchemy import Column, Double, Integer, LargeBinary, MetaData, String, Table, Text, create_engine, delete, event, func, insert, select
+from sqlalchemy.dialects.mysql import LONGBLOB
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from database import mysql_uri, pool_recycle
+
+# CHECKPOINT_BACKEND picks where conversations are kept: `memory` (one process, lost
+# on restart), or `sqlite` / `mysql` for a store shared by every worker process and
+# instance, so requests of one session may land anywhere
+checkpoint_backend = os.getenv("CHECKPOINT_BACKEND", "memory").lower()
+# `exit` writes a conversation once per turn instead of after every agent step
+checkpoint_durability = os.getenv("CHECKPOINT_DURABILITY", "exit")
+
+# in-process checkpointer with a bounded footprint: one thread per chat session,
+# only the latest checkpoint of each thread is kept, and threads are evicted when
+# there are too many of them (least recently used first), when they have been idle
+# for too long, or when a conversation outgrows its byte budget
+
+
+class BoundedMemorySaver(MemorySaver):
+    def __init__(self, max_threads: int, max_thread_bytes: int, idle_ttl: float):
+        super().__init__()
+        self.max_threads = max_threads
+        self.max_thread_bytes = max_thread_bytes
+        self.idle_ttl = idle_ttl
+        self._lock = threading.RLock()
+        # thread_id -> time of last access, least recently used first
+        self._last_access = OrderedDict()
+        self._thread_bytes = {}
+        # thread_id -> keys of the channel blobs stored for it, so pruning a thread
+        # doesn't have to scan the blobs of every other thread
+        self._blob_keys = {}
+        self.evictions = {"lru": 0, "ttl": 0, "size": 0}
+        self.pruned_checkpoints = 0
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        with self._lock:
+            self._evict_expired()
+            # a run starts by loading the latest checkpoint, which is the only safe
+            # point to reset a conversation that has grown past its budget
+            if "checkpoint_id" not in config["configurable"] and self._thread_bytes.get(thread_id, 0) > self.max_thread_bytes:
+                self._evict(thread_id, "size")
+            if thread_id in self._last_access:
+                self._touch(thread_id)
+            return super().get_tuple(config)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self._lock:
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+            thread_id = next_config["configurable"]["thread_id"]
+            checkpoint_ns = next_config["configurable"]["checkpoint_ns"]
+            self._blob_keys.setdefault(thread_id, set()).update(
+                (thread_id, checkpoint_ns, channel, version) for channel, version in new_versions.items()
+            )
+            self._touch(thread_id)
+            self._keep_latest(thread_id)
+            while len(self._last_access) > self.max_threads:
+                oldest = next(iter(self._last_access))
+                self._evict(oldest, "lru")
+            return next_config
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        with self._lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self._touch(config["configurable"]["thread_id"])
+
+    def delete_thread(self, thread_id):
+        with self._lock:
+            super().delete_thread(thread_id)
+            self._last_access.pop(thread_id, None)
+            self._thread_bytes.pop(thread_id, None)
+            self._blob_keys.pop(thread_id, None)
+
+    def _touch(self, thread_id):
+        self._last_access[thread_id] = time.monotonic()
+        self._last_access.move_to_end(thread_id)
+
+    def _evict(self, thread_id, reason):
+        self.delete_thread(thread_id)
+        self.evictions[reason] += 1
+
+    def _evict_expired(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._last_access:
+            thread_id, last_access = next(iter(self._last_access.items()))
+            if last_access > deadline:
+                break
+            self._evict(thread_id, "ttl")
+
+    def _keep_latest(self, thread_id):
+        # the agent only ever resumes from the latest checkpoint, so older ones,
+        # their pending writes and the channel blobs they alone reference are dropped
+        size = 0
+        blob_keys = self._blob_keys.get(thread_id, set())
+        for checkpoint_ns, checkpoints in self.storage[thread_id].items():
+            latest_id = max(checkpoints)
+            for checkpoint_id in [c for c in checkpoints if c != latest_id]:
+                del checkpoints[checkpoint_id]
+                self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+                self.pruned_checkpoints += 1
+
+            checkpoint, metadata, _ = checkpoints[latest_id]
+            size += len(checkpoint[1]) + len(metadata[1])
+            versions = self.serde.loads_typed(checkpoint)["channel_versions"]
+            for key in [k for k in blob_keys if k[1] == checkpoint_ns and versions.get(k[2]) != k[3]]:
+                self.blobs.pop(key, None)
+                blob_keys.discard(key)
+            for channel, version in versions.items():
+                blob = self.blobs.get((thread_id, checkpoint_ns, channel, version))
+                if blob:
+                    size += len(blob[1])
+            for _, _, value, _ in self.writes.get((thread_id, checkpoint_ns, latest_id), {}).values():
+                size += len(value[1])
+        self._thread_bytes[thread_id] = size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "threads": len(self._last_access),
+                "max_threads": self.max_threads,
+                "total_bytes": sum(self._thread_bytes.values()),
+                "largest_thread_bytes": max(self._thread_bytes.values(), default=0),
+                "max_thread_bytes": self.max_thread_bytes,
+                "idle_ttl_seconds": self.idle_ttl,
+                "evictions": dict(self.evictions),
+                "pruned_checkpoints": self.pruned_checkpoints,
+            }
+
+
+# durable checkpointer on SQLAlchemy (SQLite or MySQL): one row per checkpoint with
+# the whole serialized state, compressed, plus one row per pending write. Only the
+# latest `keep` checkpoints of a thread are kept, threads idle for longer than
+# `retention` are deleted, and recently used threads are cached in memory, checked
+# against the latest checkpoint id so writes from other processes are never missed
+
+metadata_obj = MetaData()
+blob = LargeBinary().with_variant(LONGBLOB(), "mysql")
+checkpoints_table = Table(
+    "checkpoints", metadata_obj,
+    Column("thread_id", String(64), primary_key=True),
+    Column("checkpoint_ns", String(255), primary_key=True),
+    Column("checkpoint_id", String(64), primary_key=True),
+    Column("parent_checkpoint_id", String(64)),
+    Column("type", String(32)),
+    Column("checkpoint", blob),
+    Column("metadata_type", String(32)),
+    Column("metadata", blob),
+    # serialized bytes before compression, the quantity BoundedMemorySaver counts,
+    # so MAX_THREAD_BYTES means the same for every backend
+    Column("size", Integer),
+    Column("created_at", Double, index=True),
+)
+writes_table = Table(
+    "checkpoint_writes", metadata_obj,
+    Column("thread_id", String(64), primary_key=True),
+    Column("checkpoint_ns", String(255), primary_key=True),
+    Column("checkpoint_id", String(64), primary_key=True),
+    Column("task_id", String(64), primary_key=True),
+    Column("idx", Integer, primary_key=True, autoincrement=False),
+    Column("channel", String(255)),
+    Column("type", String(32)),
+    Column("value", blob),
+    Column("task_path", Text),
+    Column("created_at", Double, index=True),
+)
+
+
+def create_tables(engine):
+    # worker processes start together; the ones losing the race find the tables made
+    try:
+        metadata_obj.create_all(engine)
+    except (OperationalError, ProgrammingError):
+        metadata_obj.create_all(engine)
+
+
+class SQLCheckpointSaver(BaseCheckpointSaver):
+    def __init__(self, engine, keep: int, max_thread_bytes: int, retention: float, cache_threads: int):
+        super().__init__()
+        self.engine = engine
+        self.keep = keep
+        self.max_thread_bytes = max_thread_bytes
+        self.retention = retention
+        self.cache_threads = cache_threads
+        create_tables(engine)
+        self._lock = threading.Lock()
+        # (thread_id, checkpoint_ns) -> (checkpoint_id, number of writes, stored row and writes)
+        self._cache = OrderedDict()
+        self._expired_at = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.evictions = {"ttl": 0, "size": 0}
+        self.pruned_checkpoints = 0
+
+    def dumps(self, value):
+        # (type, stored bytes, serialized size before compression)
+        kind, data = self.serde.dumps_typed(value)
+        if len(data) > 512:
+            return f"{kind}+zlib", zlib.compress(data), len(data)
+        return kind, data, len(data)
+
+    def loads(self, kind, data):
+        if kind.endswith("+zlib"):
+            kind, data = kind[:-5], zlib.decompress(data)
+        return self.serde.loads_typed((kind, data))
+
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        c, w = checkpoints_table.c, writes_table.c
+        with self.engine.connect() as conn:
+            if checkpoint_id is None:
+                # a run starts by loading the latest checkpoint, which is the only
+                # safe point to reset a conversation that has grown past its budget
+                writes_count = (
+                    select(func.count()).where(w.thread_id == c.thread_id, w.checkpoint_ns == c.checkpoint_ns, w.checkpoint_id == c.checkpoint_id)
+                    .scalar_subquery()
+                )
+                latest = conn.execute(
+                    select(c.checkpoint_id, c.size, writes_count)
+                    .where(c.thread_id == thread_id, c.checkpoint_ns == checkpoint_ns)
+                    .order_by(c.checkpoint_id.desc()).limit(1)
+                ).first()
+                if latest is None:
+                    return None
+                checkpoint_id, size, n_writes = latest
+                if size > self.max_thread_bytes:
+                    self.delete_thread(thread_id)
+                    self.evictions["size"] += 1
+                    return None
+                with self._lock:
+                    cached = self._cache.get((thread_id, checkpoint_ns))
+                    if cached and cached[:2] == (checkpoint_id, n_writes):
+                        self._cache.move_to_end((thread_id, checkpoint_ns))
+                        self.cache_hits += 1
+                        return self._tuple(thread_id, checkpoint_ns, *cached[2])
+            row = conn.execute(
+                select(c.checkpoint_id, c.parent_checkpoint_id, c.type, c.checkpoint, c.metadata_type, c.metadata)
+                .where(c.thread_id == thread_id, c.checkpoint_ns == checkpoint_ns, c.checkpoint_id == checkpoint_id)
+            ).first()
+            if row is None:
+                return None
+            writes = conn.execute(
+                select(w.task_path, w.task_id, w.idx, w.channel, w.type, w.value)
+                .where(w.thread_id == thread_id, w.checkpoint_ns == checkpoint_ns, w.checkpoint_id == checkpoint_id)
+                .order_by(w.task_path, w.task_id, w.idx)
+            ).all()
+        with self._lock:
+            self.cache_misses += 1
+            self._remember(thread_id, checkpoint_ns, tuple(row), [tuple(r) for r in writes])
+        return self._tuple(thread_id, checkpoint_ns, row, writes)
+
+    def _remember(self, thread_id, checkpoint_ns, row, writes):
+        # called with the lock held; the entry is used while the thread's latest
+        # checkpoint and its number of writes in the database still match it
+        self._cache[(thread_id, checkpoint_ns)] = (row[0], len(writes), (row, writes))
+        self._cache.move_to_end((thread_id, checkpoint_ns))
+        while len(self._cache) > self.cache_threads:
+            self._cache.popitem(last=False)
+
+    def _tuple(self, thread_id, checkpoint_ns, row, writes):
+        checkpoint_id, parent_id, kind, checkpoint, meta_kind, metadata = row
+        config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+        parent = {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}} if parent_id else None
+        return CheckpointTuple(
+            config=config,
+            checkpoint=self.loads(kind, checkpoint),
+            metadata=self.loads(meta_kind, metadata),
+            parent_config=parent,
+            pending_writes=[(task_id, channel, self.loads(value_kind, value)) for _, task_id, _, channel, value_kind, value in writes],
+        )
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        c = checkpoints_table.c
+        query = select(c.thread_id, c.checkpoint_ns, c.checkpoint_id).order_by(c.checkpoint_id.desc())
+        if config:
+            query = query.where(c.thread_id == config["configurable"]["thread_id"])
+            if "checkpoint_ns" in config["configurable"]:
+                query = query.where(c.checkpoint_ns == config["configurable"]["checkpoint_ns"])
+        if before:
+            query = query.where(c.checkpoint_id < get_checkpoint_id(before))
+        with self.engine.connect() as conn:
+            keys = conn.execute(query).all()
+        for thread_id, checkpoint_ns, checkpoint_id in keys:
+            found = self.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}})
+            if found is None or (filter and any(found.metadata.get(k) != v for k, v in filter.items())):
+                continue
+            yield found
+            if limit is not None:
+                limit -= 1
+                if limit <= 0:
+                    break
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        kind, data, data_size = self.dumps(checkpoint)
+        meta_kind, meta, meta_size = self.dumps(get_checkpoint_metadata(config, metadata))
+        parent_id = config["configurable"].get("checkpoint_id")
+        c = checkpoints_table.c
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(insert(checkpoints_table).values(
+                thread_id=thread_id, checkpoint_ns=checkpoint_ns, checkpoint_id=checkpoint["id"],
+                parent_checkpoint_id=parent_id, type=kind,
+                checkpoint=data, metadata_type=meta_kind, metadata=meta, size=data_size + meta_size, created_at=now,
+            ))
+            # prune in the same transaction: the newest `keep` checkpoints of the thread stay
+            stale = conn.execute(
+                select(c.checkpoint_id).where(c.thread_id == thread_id, c.checkpoint_ns == checkpoint_ns)
+                .order_by(c.checkpoint_id.desc()).offset(self.keep)
+            ).scalars().all()
+            if stale:
+                self._delete(conn, thread_id, checkpoint_ns, stale)
+                self.pruned_checkpoints += len(stale)
+            if now - self._expired_at > 60:
+                self._expired_at = now
+                self._expire(conn, now - self.retention)
+        # the next turn of this thread starts by loading what was just written
+        with self._lock:
+            self._remember(thread_id, checkpoint_ns, (checkpoint["id"], parent_id, kind, data, meta_kind, meta), [])
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        now = time.time()
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            kind, data, _ = self.dumps(value)
+            rows.append({
+                "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id, "task_id": task_id,
+                "idx": WRITES_IDX_MAP.get(channel, idx), "channel": channel, "type": kind, "value": data,
+                "task_path": task_path, "created_at": now,
+            })
+        if not rows:
+            return
+        w = writes_table.c
+        # special writes (errors, interrupts) replace earlier ones, regular writes are kept
+        special = [row["idx"] for row in rows if row["idx"] < 0]
+        with self.engine.begin() as conn:
+            if special:
+                conn.execute(delete(writes_table).where(
+                    w.thread_id == thread_id, w.checkpoint_ns == checkpoint_ns, w.checkpoint_id == checkpoint_id,
+                    w.task_id == task_id, w.idx.in_(special),
+                ))
+            conn.execute(insert(writes_table).prefix_with("OR IGNORE", dialect="sqlite").prefix_with("IGNORE", dialect="mysql"), rows)
+        # apply the same writes to a cached copy of this checkpoint
+        with self._lock:
+            cached = self._cache.get((thread_id, checkpoint_ns))
+            if cached and cached[0] == checkpoint_id:
+                row, cached_writes = cached[2]
+                kept = {(r[1], r[2]): r for r in cached_writes}
+                for r in rows:
+                    if r["idx"] < 0 or (task_id, r["idx"]) not in kept:
+                        kept[(task_id, r["idx"])] = (task_path, task_id, r["idx"], r["channel"], r["type"], r["value"])
+                self._remember(thread_id, checkpoint_ns, row, sorted(kept.values(), key=lambda r: r[:3]))
+
+    def delete_thread(self, thread_id):
+        with self.engine.begin() as conn:
+            conn.execute(delete(checkpoints_table).where(checkpoints_table.c.thread_id == thread_id))
+            conn.execute(delete(writes_table).where(writes_table.c.thread_id == thread_id))
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == thread_id]:
+                del self._cache[key]
+
+    def _delete(self, conn, thread_id, checkpoint_ns, checkpoint_ids):
+        c, w = checkpoints_table.c, writes_table.c
+        conn.execute(delete(checkpoints_table).where(c.thread_id == thread_id, c.checkpoint_ns == checkpoint_ns, c.checkpoint_id.in_(checkpoint_ids)))
+        conn.execute(delete(writes_table).where(w.thread_id == thread_id, w.checkpoint_ns == checkpoint_ns, w.checkpoint_id.in_(checkpoint_ids)))
+
+    def _expire(self, conn, cutoff):
+        # with the latest checkpoints only, old rows belong to idle threads
+        expired = conn.execute(delete(checkpoints_table).where(checkpoints_table.c.created_at < cutoff)).rowcount
+        conn.execute(delete(writes_table).where(writes_table.c.created_at < cutoff))
+        self.evictions["ttl"] += max(expired, 0)
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for found in await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit))):
+            yield found
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def stats(self) -> dict:
+        c = checkpoints_table.c
+        with self.engine.connect() as conn:
+            threads, total, largest = conn.execute(select(func.count(c.thread_id.distinct()), func.sum(c.size), func.max(c.size))).one()
+        return {
+            "backend": self.engine.dialect.name,
+            "threads": threads,
+            "total_bytes": total or 0,
+            "largest_thread_bytes": largest or 0,
+            "max_thread_bytes": self.max_thread_bytes,
+            "retention_seconds": self.retention,
+            "cached_threads": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "evictions": dict(self.evictions),
+            "pruned_checkpoints": self.pruned_checkpoints,
+        }
+
+
+def enable_wal(dbapi_conn, connection_record):
+    # several server processes share the file: readers don't block the writer
+    dbapi_conn.execute("PRAGMA journal_mode = WAL")
+    dbapi_conn.execute("PRAGMA synchronous = NORMAL")
+
+
+def checkpoint_engine():
+    if checkpoint_backend == "sqlite":
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "checkpoints.sqlite")
+        path = os.path.abspath(os.getenv("CHECKPOINT_SQLITE_PATH", default_path))
+        engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+        event.listen(engine, "connect", enable_wal)
+        return engine
+    # a pool of its own: the agent's MySQL sessions are read-only
+    return create_engine(mysql_uri(), pool_size=2, max_overflow=8, pool_recycle=pool_recycle, pool_pre_ping=True)
+
+
+def create_checkpointer():
+    if checkpoint_backend in ("sqlite", "mysql"):
+        return SQLCheckpointSaver(
+            checkpoint_engine(),
+            keep=int(os.getenv("CHECKPOINT_KEEP", 1)),
+            max_thread_bytes=int(os.getenv("MAX_THREAD_BYTES", 1_000_000)),
+            retention=float(os.getenv("CHECKPOINT_RETENTION_SECONDS", 30 * 24 * 3600)),
+            cache_threads=int(os.getenv("CHECKPOINT_CACHE_THREADS", 1000)),
+        )
+    return BoundedMemorySaver(
+        max_threads=int(os.getenv("MAX_THREADS", 1000)),
+        max_thread_bytes=int(os.getenv("MAX_THREAD_BYTES", 1_000_000)),
+        idle_ttl=float(os.getenv("THREAD_IDLE_TTL_SECONDS", 3600)),
+    )
@@ -0,0 +1,97 @@
+import os
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+# decides what the model actually sees each call; the checkpointed history itself is
+# left untouched. The current turn (last question plus the tool calls made for it so
+# far) is always sent in full. Earlier turns are reduced to question + final answer,
+# since their SQL results and tool chatter are stale, and kept newest first while
+# they fit in the token budget. Whatever doesn't fit collapses into a short rolling
+# summary, one line per turn.
+
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+summary_max_turns = int(os.getenv("SUMMARY_MAX_TURNS", 20))
+summary_line_chars = 200
+
+stats = {
+    "model_calls": 0,
+    "history_tokens_full": 0,
+    "history_tokens_sent": 0,
+    "summarized_turns": 0,
+}
+
+
+def split_turns(messages):
+    # a turn starts at a user message; system messages stored by older versions of
+    # the app are dropped, the system prompt is now added by the agent on every call
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage):
+            turns.append([message])
+        elif turns and not isinstance(message, SystemMessage):
+            turns[-1].append(message)
+    return turns
+
+
+def compact_turn(turn):
+    answers = [m for m in turn if isinstance(m, AIMessage) and not m.tool_calls and m.content]
+    return [turn[0]] + answers[-1:]
+
+
+def shorten(text, limit=summary_line_chars):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def summarize(turns):
+    lines = []
+    for turn in turns[-summary_max_turns:]:
+        question, *answer = compact_turn(turn)
+        line = f"- User asked: {shorten(question.content)}"
+        if answer:
+            line += f" | Answer: {shorten(answer[0].content)}"
+        lines.append(line)
+    return "Summary of the earlier conversation:\n" + "\n".join(lines)
+
+
+def trim_context(state):
+    turns = split_turns(state["messages"])
+    if not turns:
+        return {"llm_input_messages": state["messages"]}
+    *history, current = turns
+
+    budget = context_token_budget - count_tokens_approximately(current)
+    kept = []
+    for turn in reversed(history):
+        compact = compact_turn(turn)
+        cost = count_tokens_approximately(compact)
+        if cost > budget:
+            break
+        kept.insert(0, compact)
+        budget -= cost
+    older = history[:len(history) - len(kept)]
+
+    llm_input = []
+    if older:
+        llm_input.append(SystemMessage(content=summarize(older)))
+    for turn in kept:
+        llm_input.extend(turn)
+    llm_input.extend(current)
+
+    stats["model_calls"] += 1
+    stats["history_tokens_full"] += count_tokens_approximately(state["messages"])
+    stats["history_tokens_sent"] += count_tokens_approximately(llm_input)
+    stats["summarized_turns"] += len(older)
+    return {"llm_input_messages": llm_input}
+
+
+def add_usage(usage, message):
+    # accumulate the token counts the provider reported for one model response
+    metadata = getattr(message, "usage_metadata", None) or {}
+    usage["model_calls"] += 1
+    usage["input_tokens"] += metadata.get("input_tokens", 0)
+    usage["output_tokens"] += metadata.get("output_tokens", 0)
+
+
+def new_usage():
+    return {"model_calls": 0, "input_tokens": 0, "output_tokens": 0}
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from metadata import derived_columns
+
+# derived financial metrics computed column-wise with pandas, one vectorized
+# expression per metric; definitions follow the column descriptions given to the
+# agent in src/agent.py. Percentages are in percent, ratios are plain ratios.
+# Divisions by zero or by missing values give missing values.
+
+# base columns the derived metrics are computed from
+derived_inputs = [
+    'total_revenue', 'eps', 'dividends_per_share', 'net_income', 'ebit',
+    'gross_profit', 'total_assets', 'total_equity', 'total_liabilities',
+    'net_cash_flow_operating', 'capital_expenditures', 'current_debt',
+    'long_term_debt', 'price', 'market_value', 'common_shares_outstanding',
+    'cash', 'ebitda',
+]
+
+
+def divide(numerator, denominator):
+    return numerator / denominator.where(denominator != 0)
+
+
+def previous_year(df, column):
+    # value of `column` in the company's previous fiscal year; missing when that
+    # year is not in the data rather than silently using an older year
+    grouped = df.groupby('company_id', sort=False)
+    prior = grouped[column].shift(1)
+    prior_year = grouped['year'].shift(1)
+    return prior.where(prior_year == df['year'] - 1)
+
+
+def growth(df, column):
+    prior = previous_year(df, column)
+    return divide(df[column] - prior, prior.abs()) * 100
+
+
+def compute_derived(df):
+    # df holds company_id, year and the derived_inputs columns for complete company
+    # histories (or at least the year before every row whose growth is needed)
+    df = df.sort_values(['company_id', 'year'])
+    base = df[derived_inputs].apply(pd.to_numeric, errors='coerce').astype('float64')
+    base[['company_id', 'year']] = df[['company_id', 'year']]
+
+    debt = base['current_debt'] + base['long_term_debt']
+    free_cash_flow = base['net_cash_flow_operating'] - base['capital_expenditures']
+
+    out = pd.DataFrame({
+        'company_id': df['company_id'],
+        'year': df['year'],
+        'revenue_growth': growth(base, 'total_revenue'),
+        'eps_growth': growth(base, 'eps'),
+        'dividend_growth': growth(base, 'dividends_per_share'),
+        'net_profit_margin': divide(base['net_income'], base['total_revenue']) * 100,
+        'operating_margin': divide(base['ebit'], base['total_revenue']) * 100,
+        'gross_margin': divide(base['gross_profit'], base['total_revenue']) * 100,
+        'return_on_assets': divide(base['net_income'], base['total_assets']) * 100,
+        'return_on_equity': divide(base['net_income'], base['total_equity']) * 100,
+        'return_on_invested_capital': divide(base['net_income'], base['total_assets'] - base['total_liabilities']) * 100,
+        'free_cash_flow': free_cash_flow,
+        'free_cash_flow_margin': divide(free_cash_flow, base['total_revenue']) * 100,
+        'debt_to_equity': divide(debt, base['total_equity']),
+        'debt_to_assets': divide(debt, base['total_assets']),
+        'price_to_earnings_ratio': divide(base['price'], base['eps']),
+        'price_to_book_ratio': divide(base['market_value'], base['total_equity']),
+        'price_to_share_ratio': divide(base['market_value'], base['common_shares_outstanding']),
+        'EV_to_EBITDA_ratio': divide(base['market_value'] + base['total_liabilities'] - base['cash'], base['ebitda']),
+    })
+    out[derived_columns] = out[derived_columns].replace([np.inf, -np.inf], np.nan)
+    return out[['company_id', 'year'] + derived_columns]
+
+
+def affected_rows(derived, changed_keys):
+    # rows to rewrite after `changed_keys` changed: those rows themselves and the
+    # following year of each, whose growth columns depend on them
+    keys = pd.MultiIndex.from_arrays([derived['company_id'], derived['year']])
+    previous = pd.MultiIndex.from_arrays([derived['company_id'], derived['year'] - 1])
+    changed = pd.MultiIndex.from_tuples(list(changed_keys), names=keys.names) if changed_keys else keys[:0]
+    return derived[keys.isin(changed) | previous.isin(changed)]
@@ -1,76 +1,334 @@
 import os
-from dotenv import load_dotenv
-assert load_dotenv('.env') or load_dotenv('../.env')
+import argparse
+import csv
+import tempfile
 import time
+import numpy as np
 import pandas as pd
 import mysql.connector
-from metadata import column_mapping
+from dotenv import load_dotenv
+from metadata import column_mapping, csv_dtypes, derived_columns, company_indexes
+from derived import compute_derived, affected_rows, derived_inputs
 
 # script to create and populate MySQL database of company financial data
 # that will be queried by the LangChain agent
 # db description resides in src/agent.py
 
-start_time = time.time()
-
-db_config = {
-    'host': os.getenv('MYSQL_HOST', 'localhost'),
-    'user': os.getenv('MYSQL_USER', 'root'),
-    'port': int(os.getenv('MYSQL_PORT', 3306)),
-    'password': os.getenv('MYSQL_PASSWORD'),
-    'database': 'financial_db'
-}
+data_dir = os.path.dirname(os.path.abspath(__file__))
+key_columns = ['company_id', 'year']
 
-# Read CSV file that exists in same directory as this script
-df = pd.read_csv(f'{os.path.dirname(__file__)}/20_year_data.csv')
-df = df.rename(columns=column_mapping)
 
-# Remove duplicates: Keep the last entry for each company and year
-df = df.sort_values('year').drop_duplicates(subset=['company_id', 'year'], keep='last')
+def read_chunks(csv_path, chunk_size):
+    # stream the CSV so peak memory depends on the chunk size, not the file size;
+    # only the mapped columns are parsed, with explicit dtypes
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size, usecols=lambda col: col in column_mapping, dtype=csv_dtypes):
+        chunk = chunk.rename(columns=column_mapping)
+        # Remove duplicates: keep the last entry for each company and year. Duplicates
+        # spanning two chunks resolve the same way through ON DUPLICATE KEY UPDATE
+        chunk = chunk.dropna(subset=key_columns).drop_duplicates(subset=key_columns, keep='last')
+        yield chunk
 
-# Drop unused columns
-df = df[[col for col in df.columns if col in column_mapping.values()]]
 
-# Connect to DB
-conn = mysql.connector.connect(**db_config)
-cursor = conn.cursor()
+def to_rows(df):
+    # plain python values with None for missing data, ready for the DB driver
+    return list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
 
-columns = df.columns.tolist()
 
-# Create table with company metadata and base financial data
-with open(os.path.join(os.path.dirname(__file__),'init_company_table.sql'), 'r') as f:
-    create_table_query = f.read()
-cursor.execute(create_table_query)
-
-# Insert base financial data
-counter=0
-for _,row in df.iterrows():
-    counter += 1
-    print(f'{counter} of {len(df)}')
-    values = [row[col] if pd.notna(row[col]) else None for col in columns]
-
-    insert_query = f'''
+def upsert_query(columns):
+    return f'''
         INSERT INTO company_data ({', '.join(columns)})
         VALUES ({', '.join(['%s'] * len(columns))})
         ON DUPLICATE KEY UPDATE
-        {', '.join(f"{col} = VALUES({col})" for col in columns if col not in ['company_id', 'year'])}
+        {', '.join(f"{col} = VALUES({col})" for col in columns if col not in key_columns)}
     '''
-    cursor.execute(insert_query, values)
-
-conn.commit()
-print(f'{len(df)} rows inserted successfully')
-
-# Create derived financial columns
-with open(os.path.join(os.path.dirname(__file__), 'calculate_financial_data.sql'), 'r') as f:
-    create_procedure_query = f.read()
-cursor.execute('DROP PROCEDURE IF EXISTS calculate_financial_data')
-cursor.execute(create_procedure_query)
-cursor.callproc('calculate_financial_data')
-conn.commit()
-print(f'Derived financial metrics updated successfully')
-
-# Cleanup
-cursor.close()
-conn.close()
-
-end_time = time.time()
-print(f'⏱ Time taken: {end_time - start_time:.2f} seconds')
+
+
+def load_executemany(conn, chunks, batch_size):
+    # mysql.connector rewrites executemany of an INSERT into multi-row statements,
+    # so each batch is a single round trip; one commit per batch
+    cursor = conn.cursor()
+    rows_loaded = 0
+    for chunk in chunks:
+        insert_query = upsert_query(chunk.columns.tolist())
+        rows = to_rows(chunk)
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(insert_query, rows[start:start + batch_size])
+            conn.commit()
+        rows_loaded += len(rows)
+        yield rows_loaded
+    cursor.close()
+
+
+def load_infile(conn, chunks):
+    # LOAD DATA LOCAL INFILE from a temporary CSV per chunk; needs local_infile
+    # enabled on the server. REPLACE resets derived columns, which are recomputed
+    # after the load anyway
+    cursor = conn.cursor()
+    rows_loaded = 0
+    for chunk in chunks:
+        columns = chunk.columns.tolist()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as f:
+            chunk.to_csv(f, index=False, header=False, na_rep='\\N', quoting=csv.QUOTE_MINIMAL)
+        try:
+            cursor.execute(f'''
+                LOAD DATA LOCAL INFILE '{f.name}'
+                REPLACE INTO TABLE company_data
+                FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+                LINES TERMINATED BY '\\n'
+                ({', '.join(columns)})
+            ''')
+            conn.commit()
+        finally:
+            os.remove(f.name)
+        rows_loaded += len(chunk)
+        yield rows_loaded
+    cursor.close()
+
+
+def fetch_frame(cursor, query, params, columns):
+    cursor.execute(query, params)
+    return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+
+def changed_keys(conn, chunk):
+    # (company_id, year) of the chunk rows that are new or differ from what is
+    # stored; numbers equal up to the table's decimal rounding count as unchanged
+    cursor = conn.cursor()
+    columns = chunk.columns.tolist()
+    company_ids = [int(c) for c in chunk['company_id'].unique()]
+    existing = fetch_frame(
+        cursor,
+        f"SELECT {', '.join(columns)} FROM company_data WHERE company_id IN ({', '.join(['%s'] * len(company_ids))})",
+        company_ids,
+        columns,
+    )
+    cursor.close()
+    existing[key_columns] = existing[key_columns].astype('Int64')
+
+    merged = chunk.merge(existing, on=key_columns, how='left', suffixes=('', '_old'), indicator=True)
+    differs = (merged['_merge'] == 'left_only').to_numpy()
+    for col in columns:
+        if col in key_columns:
+            continue
+        new, old = merged[col], merged[f'{col}_old']
+        if pd.api.types.is_numeric_dtype(new):
+            new = new.to_numpy(dtype='float64', na_value=np.nan)
+            old = pd.to_numeric(old, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            same = np.isclose(new, old, rtol=1e-9, atol=0.005, equal_nan=True)
+        else:
+            same = ((new.astype(object) == old.astype(object)) | (new.isna() & old.isna())).to_numpy(dtype=bool)
+        differs |= ~same
+    return set(zip(merged.loc[differs, 'company_id'].astype(int), merged.loc[differs, 'year'].astype(int)))
+
+
+def track_changes(conn, chunks, changed, method):
+    # collects the keys touched by the load into `changed` while passing chunks on;
+    # LOAD DATA ... REPLACE clears the derived columns of every row it loads, so
+    # then all loaded rows need their metrics recomputed
+    for chunk in chunks:
+        if method == 'infile':
+            changed.update(zip(chunk['company_id'].astype(int), chunk['year'].astype(int)))
+        else:
+            changed.update(changed_keys(conn, chunk))
+        yield chunk
+
+
+def refresh_derived(conn, changed=None, batch_companies=500, batch_size=5_000):
+    # recompute derived metrics in pandas and write them back in bulk through a
+    # temporary table and a single UPDATE ... JOIN. With `changed` given, only those
+    # (company_id, year) rows and the year after each are rewritten, so the cost
+    # follows the size of the change rather than the size of the table
+    cursor = conn.cursor()
+    if changed is None:
+        cursor.execute('SELECT DISTINCT company_id FROM company_data')
+        company_ids = sorted(row[0] for row in cursor.fetchall())
+    else:
+        company_ids = sorted({company_id for company_id, _ in changed})
+
+    cursor.execute(f"""
+        CREATE TEMPORARY TABLE derived_update (
+            company_id BIGINT NOT NULL,
+            year INT NOT NULL,
+            {', '.join(f'{col} DOUBLE' for col in derived_columns)},
+            PRIMARY KEY (company_id, year)
+        )
+    """)
+    insert_query = f"""
+        INSERT INTO derived_update (company_id, year, {', '.join(derived_columns)})
+        VALUES ({', '.join(['%s'] * (len(derived_columns) + 2))})
+    """
+    rows_refreshed = 0
+    for start in range(0, len(company_ids), batch_companies):
+        batch = company_ids[start:start + batch_companies]
+        base = fetch_frame(
+            cursor,
+            f"SELECT company_id, year, {', '.join(derived_inputs)} FROM company_data WHERE company_id IN ({', '.join(['%s'] * len(batch))})",
+            batch,
+            ['company_id', 'year'] + derived_inputs,
+        )
+        derived = compute_derived(base)
+        if changed is not None:
+            derived = affected_rows(derived, changed)
+        rows = to_rows(derived)
+        for i in range(0, len(rows), batch_size):
+            cursor.executemany(insert_query, rows[i:i + batch_size])
+        rows_refreshed += len(rows)
+
+    cursor.execute(f"""
+        UPDATE company_data c
+        JOIN derived_update d ON c.company_id = d.company_id AND c.year = d.year
+        SET {', '.join(f'c.{col} = d.{col}' for col in derived_columns)}
+    """)
+    cursor.execute('DROP TEMPORARY TABLE derived_update')
+    conn.commit()
+    cursor.close()
+    return rows_refreshed
+
+
+def derived_pending(conn):
+    # True when an earlier run committed base rows but stopped before its derived
+    # refresh committed; the rows it changed no longer differ from the CSV, so an
+    # incremental refresh would not find them again
+    cursor = conn.cursor()
+    cursor.execute('CREATE TABLE IF NOT EXISTS derived_pending (id TINYINT PRIMARY KEY)')
+    cursor.execute('SELECT COUNT(*) FROM derived_pending')
+    pending = cursor.fetchone()[0] > 0
+    cursor.close()
+    return pending
+
+
+def set_derived_pending(conn, pending):
+    cursor = conn.cursor()
+    if pending:
+        cursor.execute('INSERT IGNORE INTO derived_pending (id) VALUES (1)')
+    else:
+        cursor.execute('DELETE FROM derived_pending')
+    conn.commit()
+    cursor.close()
+
+
+def create_indexes(conn):
+    # adds the indexes of company_indexes that the table does not have yet
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT DISTINCT index_name FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'company_data'
+    ''')
+    existing = {row[0] for row in cursor.fetchall()}
+    created = []
+    for name, columns in company_indexes.items():
+        if name not in existing:
+            cursor.execute(f"CREATE INDEX {name} ON company_data ({', '.join(columns)})")
+            created.append(name)
+    cursor.execute('ANALYZE TABLE company_data')
+    cursor.fetchall()
+    cursor.close()
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create and populate the company_data table.')
+    parser.add_argument('--csv', default=os.path.join(data_dir, '20_year_data.csv'), help='CSV file to load')
+    parser.add_argument('--method', choices=['executemany', 'infile'], default='executemany', help='bulk insert method')
+    parser.add_argument('--chunk-size', type=int, default=50_000, help='CSV rows read per chunk')
+    parser.add_argument('--batch-size', type=int, default=5_000, help='rows per executemany batch and commit')
+    parser.add_argument('--derived', choices=['incremental', 'full', 'procedure'], default='incremental',
+                        help='recompute derived metrics for changed rows only, for every row, or with the calculate_financial_data stored procedure. '
+                             'An incremental run after one whose refresh failed recomputes every row; --derived full also recovers stale metrics by hand')
+    parser.add_argument('--replica', action='store_true',
+                        help='also rebuild the SQLite replica used with DB_BACKEND=sqlite, at SQLITE_PATH')
+    args = parser.parse_args()
+
+    assert load_dotenv('.env') or load_dotenv('../.env')
+    start_time = time.time()
+
+    db_config = {
+        'host': os.getenv('MYSQL_HOST', 'localhost'),
+        'user': os.getenv('MYSQL_USER', 'root'),
+        'port': int(os.getenv('MYSQL_PORT', 3306)),
+        'password': os.getenv('MYSQL_PASSWORD'),
+        'database': 'financial_db',
+        'allow_local_infile': args.method == 'infile',
+    }
+
+    # Connect to DB
+    conn = mysql.connector.connect(**db_config)
+    cursor = conn.cursor()
+
+    # Create table with company metadata and base financial data
+    with open(os.path.join(data_dir, 'init_company_table.sql'), 'r') as f:
+        create_table_query = f.read()
+    cursor.execute(create_table_query)
+
+    # Insert base financial data. The pending marker is committed before the first
+    # batch and cleared only after the derived refresh commits
+    derived_mode = args.derived
+    if derived_mode == 'incremental' and derived_pending(conn):
+        print('The previous derived refresh did not complete, recomputing every row')
+        derived_mode = 'full'
+    set_derived_pending(conn, True)
+    chunks = read_chunks(args.csv, args.chunk_size)
+    changed = set()
+    if derived_mode == 'incremental':
+        chunks = track_changes(conn, chunks, changed, args.method)
+    if args.method == 'infile':
+        progress = load_infile(conn, chunks)
+    else:
+        progress = load_executemany(conn, chunks, args.batch_size)
+    rows_loaded = 0
+    for rows_loaded in progress:
+        elapsed = time.time() - start_time
+        print(f'{rows_loaded} rows loaded ({rows_loaded / elapsed:,.0f} rows/s)')
+
+    load_seconds = time.time() - start_time
+    print(f'{rows_loaded} rows inserted successfully in {load_seconds:.2f} seconds ({rows_loaded / max(load_seconds, 1e-9):,.0f} rows/s)')
+
+    # Create derived financial columns
+    derived_start = time.time()
+    if derived_mode == 'procedure':
+        with open(os.path.join(data_dir, 'calculate_financial_data.sql'), 'r') as f:
+            create_procedure_query = f.read()
+        cursor.execute('DROP PROCEDURE IF EXISTS calculate_financial_data')
+        cursor.execute(create_procedure_query)
+        cursor.callproc('calculate_financial_data')
+        conn.commit()
+        print(f'Derived financial metrics updated successfully')
+    else:
+        rows_refreshed = refresh_derived(conn, changed if derived_mode == 'incremental' else None)
+        print(f'Derived financial metrics updated for {rows_refreshed} rows in {time.time() - derived_start:.2f} seconds')
+    set_derived_pending(conn, False)
+
+    # Secondary indexes, created after the bulk load so it does not maintain them row by row
+    created = create_indexes(conn)
+    if created:
+        print(f'Indexes created: {", ".join(created)}')
+
+    # Bump the dataset version so the app's query and answer caches drop what they
+    # computed from the previous data
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dataset_version (
+            id TINYINT PRIMARY KEY,
+            version BIGINT NOT NULL,
+            loaded_at DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO dataset_version (id, version, loaded_at) VALUES (1, 1, NOW())
+        ON DUPLICATE KEY UPDATE version = version + 1, loaded_at = NOW()
+    ''')
+    conn.commit()
+
+    # Cleanup
+    cursor.close()
+    conn.close()
+
+    if args.replica:
+        from init_replica import build_replica, default_path
+        build_replica(os.getenv('SQLITE_PATH', default_path), 'mysql', args.csv, args.chunk_size)
+
+    end_time = time.time()
+    print(f'⏱ Time taken: {end_time - start_time:.2f} seconds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import os
+import sys
+import argparse
+import sqlite3
+import threading
+import time
+import pandas as pd
+from dotenv import load_dotenv
+from metadata import column_mapping, text_columns, integer_columns, derived_columns, company_indexes
+from derived import compute_derived, derived_inputs
+from init_db import read_chunks, to_rows, data_dir, key_columns
+
+# script to build the embedded SQLite replica of company_data that the app queries
+# instead of MySQL when DB_BACKEND=sqlite; built either straight from the CSV (no
+# MySQL server needed) or by copying the table init_db.py loaded into MySQL
+
+default_path = os.path.join(data_dir, 'company_data.sqlite')
+# the app's modules, for its MySQL connection settings
+sys.path.append(os.path.dirname(data_dir))
+base_columns = list(column_mapping.values())
+columns = base_columns + derived_columns
+
+
+def column_type(col):
+    if col in [column_mapping[c] for c in text_columns]:
+        return 'TEXT'
+    if col in [column_mapping[c] for c in integer_columns]:
+        return 'INTEGER'
+    return 'REAL'
+
+
+def create_tables(conn):
+    conn.execute(f'''
+        CREATE TABLE company_data (
+            {', '.join(f'{col} {column_type(col)}' for col in columns)},
+            PRIMARY KEY (company_id, year)
+        )
+    ''')
+    conn.execute('CREATE TABLE dataset_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL, loaded_at TEXT NOT NULL)')
+
+
+def create_indexes(conn):
+    for name, index_columns in company_indexes.items():
+        conn.execute(f"CREATE INDEX {name} ON company_data ({', '.join(index_columns)})")
+    conn.execute('ANALYZE')
+
+
+def insert_frames(conn, frames):
+    rows_loaded = 0
+    for df in frames:
+        df = df[[col for col in columns if col in df.columns]]
+        conn.executemany(
+            f"INSERT OR REPLACE INTO company_data ({', '.join(df.columns)}) VALUES ({', '.join(['?'] * len(df.columns))})",
+            to_rows(df),
+        )
+        rows_loaded += len(df)
+        yield rows_loaded
+
+
+def fill_derived(conn):
+    # the whole table fits in memory here, so every metric is computed in one pass
+    base = pd.read_sql(f"SELECT company_id, year, {', '.join(derived_inputs)} FROM company_data", conn)
+    derived = compute_derived(base)
+    conn.executemany(
+        f"UPDATE company_data SET {', '.join(f'{col} = ?' for col in derived_columns)} WHERE company_id = ? AND year = ?",
+        to_rows(derived[derived_columns + key_columns]),
+    )
+    return len(derived)
+
+
+def mysql_frames(chunk_size):
+    # company_data as loaded into MySQL, derived columns included
+    from sqlalchemy import create_engine
+    from database import mysql_uri
+    engine = create_engine(mysql_uri())
+    with engine.connect() as conn:
+        for chunk in pd.read_sql(f"SELECT {', '.join(columns)} FROM company_data", conn, chunksize=chunk_size):
+            yield chunk
+    engine.dispose()
+
+
+def build_replica(path, source, csv_path, chunk_size=50_000):
+    # built into a temporary file that then replaces the replica in one step, so
+    # the app never reads a half-built database; the name is unique per process and
+    # thread, so concurrent builds never write to the same file
+    start_time = time.time()
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        write_replica(tmp_path, source, csv_path, chunk_size)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    print(f'Replica {path} built from {source} in {time.time() - start_time:.2f} seconds')
+
+
+def write_replica(tmp_path, source, csv_path, chunk_size):
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    create_tables(conn)
+
+    frames = read_chunks(csv_path, chunk_size) if source == 'csv' else mysql_frames(chunk_size)
+    rows_loaded = 0
+    for rows_loaded in insert_frames(conn, frames):
+        print(f'{rows_loaded} rows copied to the replica')
+    if source == 'csv':
+        rows_refreshed = fill_derived(conn)
+        print(f'Derived financial metrics computed for {rows_refreshed} rows')
+
+    create_indexes(conn)
+    # a new version on every build, so the app's caches drop results of the old data
+    conn.execute("INSERT INTO dataset_version (id, version, loaded_at) VALUES (1, ?, datetime('now'))", (int(time.time()),))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    load_dotenv('.env') or load_dotenv('../.env')
+    parser = argparse.ArgumentParser(description='Build the SQLite replica of the company_data table.')
+    parser.add_argument('--source', choices=['csv', 'mysql'], default='csv', help='build from the CSV or copy the MySQL table')
+    parser.add_argument('--csv', default=os.path.join(data_dir, '20_year_data.csv'), help='CSV file to load')
+    parser.add_argument('--sqlite-path', default=os.getenv('SQLITE_PATH', default_path), help='replica file to write')
+    parser.add_argument('--chunk-size', type=int, default=50_000, help='rows read per chunk')
+    args = parser.parse_args()
+
+    build_replica(args.sqlite_path, args.source, args.csv, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
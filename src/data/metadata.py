@@ -34,6 +34,15 @@ column_mapping = {
     'gp': 'gross_profit'
 }
 
+# pandas dtypes of the csv columns; every column not listed here is numeric
+text_columns = ['tic', 'conm', 'loc']
+integer_columns = ['gvkey', 'gind', 'fyear']
+csv_dtypes = {
+    **{col: 'float64' for col in column_mapping},
+    **{col: 'string' for col in text_columns},
+    **{col: 'Int64' for col in integer_columns},
+}
+
 
 # Derived financial columns we will calculate
 derived_columns = [
@@ -54,4 +63,15 @@ derived_columns = [
     'price_to_book_ratio', 
     'price_to_share_ratio', 
     'EV_to_EBITDA_ratio'
-]
\ No newline at end of file
+]
+
+# secondary indexes on company_data, created by init_db.py and init_replica.py and
+# matched to the queries the agent writes: one company over the years, an industry
+# in a year, and companies in a year ranked by a frequently asked metric
+company_indexes = {
+    'idx_ticker_year': ['ticker', 'year'],
+    'idx_industry_year': ['industry_code', 'year'],
+    'idx_year_revenue': ['year', 'total_revenue'],
+    'idx_year_net_income': ['year', 'net_income'],
+    'idx_year_market_value': ['year', 'market_value'],
+}
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+
+# engine layer for the agent's SQL tool: a bounded connection pool with pre-ping
+# and recycling for connections MySQL drops when idle, read-only sessions and a
+# per-statement time limit so a runaway generated query fails fast instead of
+# holding a connection
+
+pool_size = int(os.getenv("DB_POOL_SIZE", 5))
+max_overflow = int(os.getenv("DB_MAX_OVERFLOW", 5))
+pool_timeout = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", 10))
+pool_recycle = int(os.getenv("DB_POOL_RECYCLE_SECONDS", 1800))
+statement_timeout = float(os.getenv("DB_STATEMENT_TIMEOUT_SECONDS", 10))
+
+
+class TimedPool:
+    # pool mixin counting checkouts and how long they waited for a connection
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return record
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    pass
+
+
+class TimedNullPool(TimedPool, NullPool):
+    pass
+
+
+def mysql_uri() -> str:
+    return 'mysql+mysqlconnector://{user}:{password}@{host}:{port}/financial_db'.format(
+        user=os.getenv("MYSQL_USER", "root"),
+        password=os.getenv("MYSQL_PASSWORD", "password"),
+        host=os.getenv("MYSQL_HOST", "localhost"),
+        port=os.getenv("MYSQL_PORT", 3306),
+    )
+
+
+def limit_mysql_session(dbapi_conn, connection_record):
+    # MAX_EXECUTION_TIME aborts SELECTs running longer than the limit (in ms)
+    cursor = dbapi_conn.cursor()
+    cursor.execute("SET SESSION TRANSACTION READ ONLY")
+    cursor.execute(f"SET SESSION MAX_EXECUTION_TIME = {int(statement_timeout * 1000)}")
+    cursor.close()
+
+
+def mysql_engine():
+    engine = create_engine(
+        mysql_uri(),
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=True,
+    )
+    event.listen(engine, "connect", limit_mysql_session)
+    return engine
+
+
+def prime_pool(engine):
+    # open the pool's connections now rather than on the first queries
+    size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+    connections = [engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.close()
+
+
+def pool_stats(engine) -> dict:
+    pool = engine.pool
+    stats = {
+        "pool": type(pool).__name__,
+        "checkouts": pool.checkouts,
+        "timeouts": pool.timeouts,
+        "avg_wait_ms": round(pool.wait_seconds / pool.checkouts * 1000, 3) if pool.checkouts else None,
+        "max_wait_ms": round(pool.max_wait_seconds * 1000, 3),
+    }
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "max_overflow": max_overflow,
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+        })
+    return stats
+
+
+# init_db.py bumps dataset_version.version at the end of every load; caches holding
+# query results or answers compare against it to know when they have gone stale
+
+
+class DatasetVersion:
+    def __init__(self, db, check_interval: float):
+        self.db = db
+        self.check_interval = check_interval
+        self._version = None
+        self._checked_at = float("-inf")
+
+    def current(self):
+        # re-read at most every `check_interval` seconds; if the table can't be read
+        # (a database loaded before versioning existed) the last known value is kept
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            try:
+                with self.db._engine.connect() as conn:
+                    self._version = conn.execute(text("SELECT version FROM dataset_version WHERE id = 1")).scalar() or 0
+            except Exception as e:
+                print(f'Could not read dataset version: {e}')
+                if self._version is None:
+                    self._version = 0
+        return self._version
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import re
+from typing import Optional
+from agent import db, dataset_version, db_description, results, adraw_chart, PlotInput, MultiPlotInput
+from results import to_frame
+
+# deterministic answers for the most common question shapes, without the agent:
+#   "What was AAPL's revenue from 2015 to 2024?"    one company over the years (line)
+#   "Revenue of AAPL, MSFT and GOOG in 2023"        companies in one year (bar)
+#   "Compare AAPL and MSFT revenue since 2015"      companies over the years (multiline)
+#   "AAPL revenue trend", "AAPL eps until 2020"     every year, or every year up to one
+# A question is only taken when every word of it is understood: one metric, the
+# companies, the years and filler words. Anything else goes to the agent.
+
+# metric column -> unit, from the column descriptions given to the agent
+identifier_columns = {"company_id", "ticker", "company_name", "country", "industry_code", "year"}
+units = {}
+for name, description in re.findall(r"^\d+\. (\w+): (.*)$", db_description, re.MULTILINE):
+    if name in identifier_columns:
+        continue
+    if "millions USD" in description:
+        units[name] = " million USD"
+    elif "(in USD)" in description:
+        units[name] = " USD"
+    elif "percentage" in description or name.endswith("_growth"):
+        units[name] = "%"
+    else:
+        units[name] = ""
+
+# phrases naming a metric; every column is also named by its own words
+metric_aliases = {
+    **{name.replace("_", " ").lower(): name for name in units},
+    "revenue": "total_revenue",
+    "revenues": "total_revenue",
+    "sales": "total_revenue",
+    "net income": "net_income",
+    "profit": "net_income",
+    "earnings": "net_income",
+    "earnings per share": "eps",
+    "dividend": "dividends_per_share",
+    "dividends": "dividends_per_share",
+    "market cap": "market_value",
+    "market capitalization": "market_value",
+    "stock price": "price",
+    "share price": "price",
+    "fcf": "free_cash_flow",
+    "capex": "capital_expenditures",
+    "net margin": "net_profit_margin",
+    "profit margin": "net_profit_margin",
+    "roa": "return_on_assets",
+    "roe": "return_on_equity",
+    "roic": "return_on_invested_capital",
+    "p/e": "price_to_earnings_ratio",
+    "pe ratio": "price_to_earnings_ratio",
+    "p/e ratio": "price_to_earnings_ratio",
+    "p/b": "price_to_book_ratio",
+    "p/b ratio": "price_to_book_ratio",
+    "d/e": "debt_to_equity",
+    "ev/ebitda": "EV_to_EBITDA_ratio",
+    "ev to ebitda": "EV_to_EBITDA_ratio",
+}
+metric_pattern = re.compile(
+    r"(?<![\w/])(" + "|".join(re.escape(p) for p in sorted(metric_aliases, key=len, reverse=True)) + r")(?![\w/])"
+)
+year_pattern = re.compile(r"\b((?:19|20)\d{2})\b")
+filler_words = set("""
+    what whats was were is are the of for from to between and in on show me plot chart graph draw give
+    compare comparison vs versus over time years year since through until till trend how did has have a an
+    their its s please tell about across during each per by with history
+""".split())
+# without a year, words asking for every year, and words that need a year to say which
+trend_words = {"over", "time", "years", "trend", "each", "per", "across", "history"}
+range_words = {"from", "since", "until", "till", "through", "between"}
+
+
+class CompanyDirectory:
+    # tickers, distinctive first words of company names and the latest year in
+    # the data, reloaded whenever the dataset version changes
+    def __init__(self):
+        self.version = None
+        self.tickers = set()
+        self.names = {}
+        self.earliest_year = None
+        self.latest_year = None
+
+    def refresh(self):
+        version = dataset_version.current()
+        if version == self.version:
+            return
+        rows = db._execute("SELECT DISTINCT ticker, company_name FROM company_data", fetch="all")
+        first_words = {}
+        for row in rows:
+            if row["company_name"]:
+                word = row["company_name"].split()[0].lower()
+                first_words.setdefault(word, set()).add(row["ticker"])
+        self.tickers = {row["ticker"] for row in rows if row["ticker"]}
+        # only names that point at one company and can't be mistaken for other words
+        self.names = {
+            word: next(iter(tickers)) for word, tickers in first_words.items()
+            if len(tickers) == 1 and len(word) >= 4 and word not in filler_words and word not in metric_aliases
+        }
+        years = db._execute("SELECT MIN(year) AS earliest, MAX(year) AS latest FROM company_data", fetch="all")[0]
+        self.earliest_year, self.latest_year = years["earliest"], years["latest"]
+        self.version = version
+
+
+directory = CompanyDirectory()
+stats = {"answered": 0, "passed": 0}
+
+
+def parse(question: str) -> Optional[dict]:
+    # the metric, companies and years of a question, or None when it does not fit
+    text = re.sub(r"['’]s\b", " ", question.strip().rstrip("?!. "))
+    chars = list(text)
+    metrics = set()
+    for match in metric_pattern.finditer(text.lower()):
+        metrics.add(metric_aliases[match.group(1)])
+        chars[match.start():match.end()] = " " * (match.end() - match.start())
+    if len(metrics) != 1:
+        return None
+    rest = "".join(chars)
+    years = sorted(int(year) for year in year_pattern.findall(rest))
+    with_years = rest.lower()
+    rest = year_pattern.sub(" ", rest)
+
+    tickers = []
+    for word in re.findall(r"[A-Za-z][A-Za-z0-9.&-]*", rest):
+        word = word.rstrip(".&-")
+        # tickers count when written in capitals, company names in any case
+        if len(word) >= 2 and word.isupper() and word in directory.tickers:
+            ticker = word
+        elif word.lower() in directory.names:
+            ticker = directory.names[word.lower()]
+        elif word.lower() in filler_words:
+            continue
+        else:
+            return None
+        if ticker not in tickers:
+            tickers.append(ticker)
+    if not tickers:
+        return None
+
+    words = set(re.findall(r"[a-z]+", rest.lower()))
+    if len(years) >= 2:
+        start, end = years[0], years[-1]
+    elif years:
+        # "from/since 2015" runs to the latest year, "until/through 2020" from the earliest
+        start = end = years[0]
+        if re.search(rf"\b(from|since)\s+(year\s+)?{start}\b", with_years):
+            end = directory.latest_year
+        elif re.search(rf"\b(until|till|through|to)\s+(year\s+)?{end}\b", with_years):
+            start = directory.earliest_year
+    elif words & range_words:
+        return None
+    elif words & trend_words:
+        start, end = directory.earliest_year, directory.latest_year
+    else:
+        # like the agent, the latest year when no range is asked for
+        start = end = directory.latest_year
+    return {"metric": metrics.pop(), "tickers": tickers, "start": start, "end": end}
+
+
+def label(metric: str) -> str:
+    return "EV/EBITDA ratio" if metric == "EV_to_EBITDA_ratio" else metric.replace("_", " ")
+
+
+def fmt(value, metric: str) -> str:
+    return "no data" if value is None else f"{value:,.2f}{units[metric]}"
+
+
+def fetch(metric: str, tickers: list, start: int, end: int):
+    # parameterized over the companies and years; the metric is one of the known columns
+    params = {f"t{i}": ticker for i, ticker in enumerate(tickers)}
+    query = (
+        f"SELECT ticker, year, {metric} FROM company_data "
+        f"WHERE ticker IN ({', '.join(':' + name for name in params)}) AND year BETWEEN :start AND :end "
+        f"ORDER BY ticker, year"
+    )
+    params.update({"start": start, "end": end})
+    rows = db._execute(query, fetch="all", parameters=params)
+    return query, params, rows
+
+
+def store(query: str, params: dict, rows) -> str:
+    results.frames.sync_version(dataset_version.current())
+    handle = results.handle_for(f"{query} {json.dumps(params, sort_keys=True)}")
+    results.put(handle, to_frame(rows))
+    return handle
+
+
+async def fast_answer(question: str) -> Optional[dict]:
+    # {"response", "graph_url"} for questions of the shapes above, None otherwise
+    await asyncio.to_thread(directory.refresh)
+    parsed = parse(question)
+    if parsed is None:
+        stats["passed"] += 1
+        return None
+    metric, tickers, start, end = parsed["metric"], parsed["tickers"], parsed["start"], parsed["end"]
+    query, params, rows = await asyncio.to_thread(fetch, metric, tickers, start, end)
+    stats["answered"] += 1
+    name = label(metric)
+    years = f"{start}" if start == end else f"{start}-{end}"
+    if not rows:
+        return {"response": f"No data found for {', '.join(tickers)} {name} in {years}.", "graph_url": None}
+
+    # same rules as the agent: no chart below 3 data points, values in the text up
+    # to 10 data points
+    if len(tickers) == 1 and start == end:
+        return {"response": f"{tickers[0]} {name} in {start}: {fmt(rows[0][metric], metric)}.", "graph_url": None}
+    if len(tickers) == 1:
+        lines = [f"{row['year']}: {fmt(row[metric], metric)}" for row in rows]
+        kind, inputs = "line", PlotInput(result="", x="year", y=metric, title=f"{tickers[0]} {name}", xlabel="Year", ylabel=name)
+    elif start == end:
+        rows = sorted(rows, key=lambda row: tickers.index(row["ticker"]))
+        lines = [f"{row['ticker']}: {fmt(row[metric], metric)}" for row in rows]
+        kind, inputs = "bar", PlotInput(result="", x="ticker", y=metric, title=f"{name} in {start}", xlabel="Company", ylabel=name)
+    else:
+        lines = [f"{row['ticker']} {row['year']}: {fmt(row[metric], metric)}" for row in rows]
+        kind, inputs = "multiline", MultiPlotInput(result="", x="year", y=[metric], series="ticker", title=f"{name}, {years}", xlabel="Year", ylabel=name)
+
+    graph_url = None
+    if len(rows) >= 3:
+        inputs.result = store(query, params, rows)
+        _, artifact = await adraw_chart(kind, inputs)
+        graph_url = artifact["graph_url"] if artifact else None
+    if len(rows) <= 10 or graph_url is None:
+        response = f"{', '.join(tickers)} {name}, {years}:\n" + "\n".join(lines)
+    else:
+        response = f"{', '.join(tickers)} {name}, {years}."
+    return {"response": response, "graph_url": graph_url}
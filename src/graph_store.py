@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from cache import TTLCache
+
+# content-addressed store for rendered charts: a chart's file name is a hash of
+# everything that determines its pixels (chart type, data, labels and render
+# settings), so an identical chart is a lookup instead of a render. Files are
+# evicted least recently used first once the store exceeds its byte or file budget,
+# and the most recently served images are also kept in memory
+
+media_types = {"png": "image/png", "svg": "image/svg+xml", "webp": "image/webp"}
+# names name_for gives; anything else in the folder (temporary files) is left alone
+chart_name = re.compile(r"[0-9a-f]{32}\.(png|svg|webp)")
+
+
+class GraphStore:
+    def __init__(self, folder: str, max_bytes: int, max_files: int, hot_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.hot = TTLCache(max_entries=1000, max_bytes=hot_bytes, ttl=24 * 3600)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # file name -> (size, mtime when last seen), least recently used first
+        self._files = OrderedDict()
+
+        os.makedirs(folder, exist_ok=True)
+        entries = [e for e in os.scandir(folder) if e.is_file() and chart_name.fullmatch(e.name)]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self._files[entry.name] = (entry.stat().st_size, entry.stat().st_mtime)
+            self.bytes += entry.stat().st_size
+        with self._lock:
+            self._evict()
+
+    @staticmethod
+    def name_for(kind: str, spec: dict, fmt: str, dpi: int, size) -> str:
+        payload = json.dumps([kind, spec, fmt, dpi, list(size)], sort_keys=True, default=str)
+        return f"{hashlib.sha256(payload.encode()).hexdigest()[:32]}.{fmt}"
+
+    def contains(self, name: str) -> bool:
+        # checks the folder rather than only this process's index: other processes
+        # sharing it add and evict charts too. Touching the file marks the chart as
+        # recently used for all of them
+        if not chart_name.fullmatch(name):
+            return False
+        path = os.path.join(self.folder, name)
+        try:
+            os.utime(path)
+            stat = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(name)
+                self.misses += 1
+            return False
+        with self._lock:
+            self._record(name, stat.st_size, stat.st_mtime)
+            self.hits += 1
+            self._evict()
+        return True
+
+    def get(self, name: str):
+        data = self.hot.get(name)
+        if data is not None:
+            return data
+        if not chart_name.fullmatch(name):
+            return None
+        try:
+            with open(os.path.join(self.folder, name), "rb") as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(name)
+            return None
+        # a chart missing from the index was rendered by another process
+        with self._lock:
+            self._record(name, len(data), mtime)
+            self._evict()
+        self.hot.put(name, data, len(data))
+        return data
+
+    def put(self, name: str, data: bytes):
+        # write to a temporary file first so a concurrent reader never sees half an
+        # image; the name is unique across the processes sharing the folder
+        path = os.path.join(self.folder, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        mtime = os.stat(path).st_mtime
+        with self._lock:
+            self._record(name, len(data), mtime)
+            self._evict()
+        self.hot.put(name, data, len(data))
+
+    def _record(self, name, size, mtime):
+        # adds or refreshes a file as the most recently used
+        self._forget(name)
+        self._files[name] = (size, mtime)
+        self.bytes += size
+
+    def _forget(self, name):
+        entry = self._files.pop(name, None)
+        if entry is not None:
+            self.bytes -= entry[0]
+
+    def _evict(self):
+        # other processes may have removed a file already, or written or used it
+        # since this one last saw it; only files unchanged since then are deleted
+        while self._files and (len(self._files) > self.max_files or self.bytes > self.max_bytes):
+            name, (size, mtime) = next(iter(self._files.items()))
+            path = os.path.join(self.folder, name)
+            try:
+                current = os.stat(path).st_mtime
+            except FileNotFoundError:
+                self._forget(name)
+                continue
+            if current > mtime:
+                self._record(name, size, current)
+                continue
+            self._forget(name)
+            self.hot.discard(name)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self.bytes,
+                "max_files": self.max_files,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hot": self.hot.stats(),
+            }
+
+
+graph_store = GraphStore(
+    folder=os.getenv("GRAPH_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "graph")),
+    max_bytes=int(os.getenv("GRAPH_STORE_MAX_BYTES", 500_000_000)),
+    max_files=int(os.getenv("GRAPH_STORE_MAX_FILES", 10_000)),
+    hot_bytes=int(os.getenv("GRAPH_HOT_CACHE_BYTES", 32_000_000)),
+)
@@ -0,0 +1,93 @@
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+# admission control for agent runs: at most `max_in_flight` run concurrently,
+# up to `max_queued` more wait (for at most `queue_timeout` seconds) for a slot,
+# everything beyond that is rejected so the server can answer 429 immediately
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_in_flight: int, max_queued: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.aborted = 0
+        # exponential moving average of run time, used to size Retry-After
+        self.avg_run_seconds = 5.0
+
+    def retry_after(self) -> int:
+        backlog = self.waiting + self.in_flight + 1
+        return max(1, math.ceil(self.avg_run_seconds * backlog / self.max_in_flight))
+
+    async def acquire(self) -> float:
+        if not self._semaphore.locked():
+            # a slot is free, acquire() returns without suspending
+            await self._semaphore.acquire()
+        elif self.waiting >= self.max_queued:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after())
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise QueueFullError(self.retry_after())
+            finally:
+                self.waiting -= 1
+
+        self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start: float, completed: bool = True):
+        self.in_flight -= 1
+        self._semaphore.release()
+        if completed:
+            self.completed += 1
+            self.avg_run_seconds = 0.8 * self.avg_run_seconds + 0.2 * (time.monotonic() - start)
+        else:
+            # cancelled (client went away) or failed runs don't count towards the average
+            self.aborted += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        start = await self.acquire()
+        completed = False
+        try:
+            yield
+            completed = True
+        finally:
+            self.release(start, completed)
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "aborted": self.aborted,
+            "avg_run_seconds": round(self.avg_run_seconds, 3),
+        }
+
+
+limiter = ConcurrencyLimiter(
+    max_in_flight=int(os.getenv("MAX_IN_FLIGHT", 8)),
+    max_queued=int(os.getenv("MAX_QUEUED", 32)),
+    queue_timeout=float(os.getenv("QUEUE_TIMEOUT_SECONDS", 10)),
+)
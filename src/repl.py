@@ -0,0 +1,119 @@
+import io
+import os
+import resource
+import signal
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from workers import WorkerPool
+
+# Python execution for the python_repl tool: code runs in a pool of worker processes
+# that import pandas and NumPy once when they start, so analysis for concurrent
+# requests runs in parallel and off the server's event loop and GIL. Every run is
+# limited in CPU time, wall time and memory, and workers are replaced after a number
+# of runs. Query results are passed in as DataFrames named by their handles.
+# The limits protect the server from runaway code; they are not a security sandbox.
+
+repl_workers = int(os.getenv("REPL_WORKERS", min(2, os.cpu_count() or 1)))
+repl_cpu_seconds = int(os.getenv("REPL_CPU_SECONDS", 10))
+repl_wall_seconds = float(os.getenv("REPL_WALL_SECONDS", 20))
+repl_memory_mb = int(os.getenv("REPL_MEMORY_MB", 1024))
+repl_max_runs = int(os.getenv("REPL_MAX_RUNS_PER_WORKER", 50))
+repl_output_chars = int(os.getenv("REPL_OUTPUT_CHARS", 4000))
+# time the worker gets to report its own timeout before it is killed
+kill_grace_seconds = 2
+
+
+class ReplError(Exception):
+    pass
+
+
+class RunLimitExceeded(Exception):
+    pass
+
+
+def address_space() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def over_cpu_limit(signum, frame):
+    raise RunLimitExceeded(f"CPU time limit of {repl_cpu_seconds}s exceeded")
+
+
+def over_wall_limit(signum, frame):
+    raise RunLimitExceeded(f"time limit of {repl_wall_seconds}s exceeded")
+
+
+def warm_worker():
+    # process initializer: one BLAS thread per worker (the pool is the parallelism),
+    # pay for the pandas and NumPy imports, then cap the address space at what they
+    # take plus the memory limit
+    for name in ("OPENBLAS_NUM_THREADS", "OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(name, "1")
+    import numpy
+    import pandas
+    pandas.DataFrame({"x": numpy.arange(3)}).describe()
+    used = address_space()
+    if used and repl_memory_mb:
+        limit = used + repl_memory_mb * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    signal.signal(signal.SIGXCPU, over_cpu_limit)
+    signal.signal(signal.SIGALRM, over_wall_limit)
+
+
+def run(code: str, frames: dict) -> str:
+    # executes in a worker with a fresh namespace: pd, np and the frames passed in
+    # (also as `df` when there is one); returns what the code printed
+    import numpy
+    import pandas
+    namespace = {"pd": pandas, "np": numpy, **frames}
+    if len(frames) == 1:
+        namespace["df"] = next(iter(frames.values()))
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime) + repl_cpu_seconds + 1, hard))
+    signal.setitimer(signal.ITIMER_REAL, repl_wall_seconds)
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output), redirect_stderr(output):
+            exec(code, namespace)
+    except RunLimitExceeded as e:
+        output.write(f"\nError: {e}")
+    except MemoryError:
+        output.write(f"\nError: memory limit of {repl_memory_mb} MB exceeded")
+    except (Exception, SystemExit) as e:
+        # the failing line of the submitted code, not the worker's frames
+        frame = traceback.extract_tb(e.__traceback__)[-1]
+        line = f" (line {frame.lineno})" if frame.filename == "<string>" else ""
+        output.write(f"\nError{line}: {type(e).__name__}: {e}")
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, hard))
+
+    text = output.getvalue().strip()
+    if len(text) > repl_output_chars:
+        text = text[:repl_output_chars] + f"\n... output truncated at {repl_output_chars} characters"
+    return text or "The code ran without printing anything; use print(...) to see values."
+
+
+pool = WorkerPool(
+    repl_workers,
+    repl_wall_seconds + kill_grace_seconds,
+    ReplError,
+    initializer=warm_worker,
+    max_tasks_per_child=repl_max_runs,
+    timeout_message=f"the code did not finish within {repl_wall_seconds}s and was stopped",
+    crash_message="the Python worker crashed (out of memory?), try again",
+)
+
+
+async def run_code(code: str, frames: dict) -> str:
+    return await pool.acall(run, code, frames)
+
+
+def run_code_sync(code: str, frames: dict) -> str:
+    return pool.call(run, code, frames)
@@ -0,0 +1,138 @@
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from database import TimedNullPool, statement_timeout
+
+# embedded SQLite replica of company_data (DB_BACKEND=sqlite), built by
+# data/init_replica.py from the CSV or from MySQL. The app opens it read-only, and
+# the MySQL functions generated queries commonly use are registered on every
+# connection so they run unchanged
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+replica_path = os.path.abspath(os.getenv("SQLITE_PATH", os.path.join(data_dir, "company_data.sqlite")))
+
+
+def null_safe(func):
+    # like MySQL, any NULL argument gives NULL
+    def wrapper(*args):
+        if any(arg is None for arg in args):
+            return None
+        try:
+            return func(*args)
+        except (ValueError, ZeroDivisionError, OverflowError):
+            return None
+    return wrapper
+
+
+class Deviation:
+    # STDDEV / VARIANCE aggregates; population statistics unless `sample`
+    sample = False
+    squared = False
+
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(float(value))
+
+    def finalize(self):
+        if len(self.values) < (2 if self.sample else 1):
+            return None
+        if self.squared:
+            return statistics.variance(self.values) if self.sample else statistics.pvariance(self.values)
+        return statistics.stdev(self.values) if self.sample else statistics.pstdev(self.values)
+
+
+def aggregate(sample: bool, squared: bool):
+    return type("Aggregate", (Deviation,), {"sample": sample, "squared": squared})
+
+
+scalar_functions = {
+    "IF": (3, lambda condition, a, b: a if condition else b),
+    "GREATEST": (-1, null_safe(max)),
+    "LEAST": (-1, null_safe(min)),
+    "CONCAT": (-1, null_safe(lambda *args: "".join(str(arg) for arg in args))),
+    "POW": (2, null_safe(math.pow)),
+    "POWER": (2, null_safe(math.pow)),
+    "SQRT": (1, null_safe(math.sqrt)),
+    "LN": (1, null_safe(math.log)),
+    "LOG10": (1, null_safe(math.log10)),
+    "EXP": (1, null_safe(math.exp)),
+    "TRUNCATE": (2, null_safe(lambda x, d: math.trunc(x * 10 ** d) / 10 ** d)),
+}
+aggregate_functions = {
+    "STD": aggregate(sample=False, squared=False),
+    "STDDEV": aggregate(sample=False, squared=False),
+    "STDDEV_POP": aggregate(sample=False, squared=False),
+    "STDDEV_SAMP": aggregate(sample=True, squared=False),
+    "VARIANCE": aggregate(sample=False, squared=True),
+    "VAR_POP": aggregate(sample=False, squared=True),
+    "VAR_SAMP": aggregate(sample=True, squared=True),
+}
+
+
+def register_mysql_functions(dbapi_conn, connection_record):
+    for name, (n_args, func) in scalar_functions.items():
+        dbapi_conn.create_function(name, n_args, func, deterministic=True)
+    for name, cls in aggregate_functions.items():
+        dbapi_conn.create_aggregate(name, 1, cls)
+    dbapi_conn.execute("PRAGMA query_only = ON")
+    # SQLite has no statement timeout; a progress handler interrupts the running
+    # statement once the deadline set when it started has passed
+    deadline = [float("inf")]
+    connection_record.info["deadline"] = deadline
+    dbapi_conn.set_progress_handler(lambda: time.monotonic() > deadline[0], 10_000)
+
+
+def start_statement_clock(conn, cursor, statement, parameters, context, executemany):
+    conn.info["deadline"][0] = time.monotonic() + statement_timeout
+
+
+@contextmanager
+def build_lock(path: str):
+    # an exclusive lock next to the replica, so of several server workers starting
+    # together only one builds it
+    try:
+        import fcntl
+    except ImportError:
+        # no flock on Windows: builds may overlap, each writes its own temporary file
+        yield
+        return
+    with open(f"{path}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def ensure_replica(path: str = replica_path):
+    # build the replica on first start; REPLICA_SOURCE=mysql copies an existing
+    # MySQL load instead of reading the CSV
+    if os.path.exists(path):
+        return
+    with build_lock(path):
+        # another process may have built it while this one waited for the lock
+        if os.path.exists(path):
+            return
+        print(f"Building the SQLite replica at {path}")
+        subprocess.run(
+            [sys.executable, "init_replica.py", "--sqlite-path", path, "--source", os.getenv("REPLICA_SOURCE", "csv")],
+            cwd=data_dir,
+            check=True,
+        )
+
+
+def replica_engine(path: str = replica_path):
+    # a connection per checkout rather than a pool: opening SQLite is cheap, and a
+    # rebuilt replica replaces the file, which pooled connections would not notice
+    engine = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true", poolclass=TimedNullPool)
+    event.listen(engine, "connect", register_mysql_functions)
+    event.listen(engine, "before_cursor_execute", start_statement_clock)
+    return engine
@@ -0,0 +1,108 @@
+import hashlib
+import pandas as pd
+from cache import TTLCache
+
+# query results kept server-side as DataFrames under short handles: the model sees a
+# compact preview and passes the handle and column names to the chart tools, which
+# read the values from here instead of the model writing every number back out
+
+
+def to_frame(rows) -> pd.DataFrame:
+    # rows as returned by SQLDatabase._execute (a list of dicts); DECIMAL columns
+    # arrive as Decimal objects and are converted to floats
+    df = pd.DataFrame.from_records(rows)
+    for col in df.columns:
+        if df[col].dtype == object:
+            try:
+                df[col] = pd.to_numeric(df[col])
+            except (ValueError, TypeError):
+                pass
+    return df
+
+
+def frame_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class ResultStore:
+    def __init__(self, frames: TTLCache, preview_rows: int, max_cell_chars: int):
+        # `frames` is the SQL result cache, so a repeated query reuses its frame and
+        # handles become invalid when the dataset version changes
+        self.frames = frames
+        self.preview_rows = preview_rows
+        self.max_cell_chars = max_cell_chars
+
+    @staticmethod
+    def handle_for(key: str) -> str:
+        # the same query against the same data always gets the same handle
+        return "r" + hashlib.sha1(key.encode()).hexdigest()[:8]
+
+    def put(self, handle: str, df: pd.DataFrame) -> bool:
+        return self.frames.put(handle, df, frame_size(df))
+
+    def get(self, handle: str):
+        return self.frames.get(handle.strip())
+
+    def preview(self, handle: str, df: pd.DataFrame, stored: bool = True) -> str:
+        # `stored` is False when the frame was too large for the store, so the
+        # handle cannot be used by the chart tools
+        if df.empty:
+            return "The query returned no rows."
+        columns = ", ".join(f"{col} ({df[col].dtype})" for col in df.columns)
+        shown = df.head(self.preview_rows).astype(object).where(df.notna(), None)
+        rows = "\n".join(
+            str(tuple(str(v)[:self.max_cell_chars] if isinstance(v, str) else v for v in row))
+            for row in shown.itertuples(index=False, name=None)
+        )
+        text = f"Result {handle}: {len(df)} rows; columns: {columns}\n{rows}"
+        if len(df) > self.preview_rows:
+            text += f"\n... {len(df) - self.preview_rows} more rows"
+            if stored:
+                text += f" (use the handle {handle} to chart them)"
+        if not stored:
+            text += (
+                f"\nThis result is too large to keep, so {handle} cannot be charted or passed to python_repl. "
+                f"Aggregate or filter it in SQL and run the smaller query instead."
+            )
+        if df.attrs.get("note"):
+            text += f"\n{df.attrs['note']}"
+        return text
+
+
+def column(df: pd.DataFrame, name: str) -> pd.Series:
+    if name not in df.columns:
+        raise ValueError(f"no column '{name}' in the result, its columns are: {', '.join(map(str, df.columns))}")
+    return df[name]
+
+
+def numeric(df: pd.DataFrame, name: str) -> pd.Series:
+    values = column(df, name)
+    if not pd.api.types.is_numeric_dtype(values):
+        raise ValueError(f"column '{name}' is not numeric")
+    return values.astype("float64")
+
+
+def series_data(df: pd.DataFrame, x: str, y: str) -> dict:
+    # one series: rows without a y value are left out
+    data = pd.DataFrame({"x": column(df, x), "y": numeric(df, y)}).dropna(subset=["y"])
+    return {"x": data["x"].tolist(), "y": data["y"].tolist()}
+
+
+def multi_series_data(df: pd.DataFrame, x: str, y: list, series=None) -> dict:
+    # several series, either one per y column (wide results) or, with `series`, one
+    # per distinct value of that column (long results such as year, ticker, value)
+    if series is None:
+        return {
+            "x": column(df, x).tolist(),
+            "y": [numeric(df, name).tolist() for name in y],
+            "labels": list(y),
+        }
+    if len(y) != 1:
+        raise ValueError("give exactly one y column together with a series column")
+    data = pd.DataFrame({"x": column(df, x), "series": column(df, series), "y": numeric(df, y[0])})
+    table = data.pivot_table(index="x", columns="series", values="y", aggfunc="first", sort=True)
+    return {
+        "x": table.index.tolist(),
+        "y": [table[label].tolist() for label in table.columns],
+        "labels": [str(label) for label in table.columns],
+    }
@@ -1,16 +1,96 @@
 import os
 import uuid
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+import asyncio
+import json
+import re
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse, Response
+from starlette.datastructures import MutableHeaders
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from agent import query_agent 
+
+# before the modules below read their settings
+load_dotenv('.env') or load_dotenv('../.env')
+
+from cache import TTLCache
+import charts
+import repl
+from graph_store import graph_store, media_types
+from limiter import limiter, QueueFullError
+from telemetry import begin_request, end_request, activate, trace_request, span
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, generate_latest
 from fastapi.middleware.cors import CORSMiddleware
 
-assert load_dotenv('.env') or load_dotenv('../.env')
+# the agent, the model and the database are loaded in the background once the
+# server is up, so the process accepts connections (and answers /healthz) right
+# away; requests arriving before the agent is loaded wait for it
+agent = None
+context = None
+database = None
+fast_path = None
+startup_task = None
+warm_up_task = None
+# prime the connection pool, the fast path and the chart and Python workers after loading
+warm_up_enabled = os.getenv("WARM_UP", "1") == "1"
+
+def load_agent():
+    global agent, context, database, fast_path
+    import agent, context, database, fast_path
+
+def warm_up():
+    start = time.perf_counter()
+    for name, step in [("connection pool", lambda: database.prime_pool(agent.engine)),
+                       ("fast path", fast_path.directory.refresh),
+                       ("chart renderer", charts.pool.warm_up),
+                       ("Python workers", repl.pool.warm_up)]:
+        try:
+            step()
+        except Exception as e:
+            print(f'Warm-up of the {name} failed: {e}')
+    print(f'Warm-up done in {time.perf_counter() - start:.1f}s')
+
+async def start_up():
+    global warm_up_task
+    start = time.perf_counter()
+    try:
+        await asyncio.to_thread(load_agent)
+    except Exception as e:
+        print(f'Could not load the agent: {e}')
+        raise
+    print(f'Agent loaded in {time.perf_counter() - start:.1f}s')
+    if warm_up_enabled:
+        warm_up_task = asyncio.ensure_future(asyncio.to_thread(warm_up))
+
+def begin_startup():
+    # also called by the first request when the app runs without lifespan events
+    global startup_task
+    if startup_task is None:
+        startup_task = asyncio.ensure_future(start_up())
+    return startup_task
 
-app = FastAPI()
+async def wait_until_ready() -> bool:
+    try:
+        await asyncio.shield(begin_startup())
+    except Exception:
+        return False
+    return True
+
+def unavailable_response():
+    return JSONResponse(status_code=503, content={"error": "the agent could not be loaded"}, headers={"Retry-After": "30"})
+
+@asynccontextmanager
+async def lifespan(app):
+    begin_startup()
+    yield
+    charts.pool.shutdown()
+    repl.pool.shutdown()
+    if agent is not None:
+        agent.engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -20,37 +100,292 @@ app.add_middleware(
 )
 
 app_dir = os.path.dirname(os.path.abspath(__file__))
-graph_folder = os.path.join(app_dir, 'graph')
-os.makedirs(graph_folder, exist_ok=True)
 static_dir = os.path.join(app_dir, 'static')
 
-app.mount("/graph", StaticFiles(directory=graph_folder), name="graph")
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
+# every browser gets its own conversation thread, identified by a cookie the server
+# issues on first contact (API clients may send the X-Session-Id header instead)
+session_cookie = "session_id"
+session_id_pattern = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+session_max_age = int(os.getenv("SESSION_MAX_AGE_SECONDS", 30 * 24 * 3600))
+
+class SessionMiddleware:
+    # plain ASGI rather than @app.middleware("http") so streamed responses and
+    # disconnect detection pass through untouched
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request = Request(scope)
+        session_id = request.headers.get("X-Session-Id") or request.cookies.get(session_cookie)
+        is_new = not (session_id and session_id_pattern.match(session_id))
+        if is_new:
+            session_id = uuid.uuid4().hex
+        scope.setdefault("state", {})["session_id"] = session_id
+
+        async def send_with_cookie(message):
+            if is_new and message["type"] == "http.response.start":
+                cookie = Response()
+                cookie.set_cookie(session_cookie, session_id, max_age=session_max_age, httponly=True, samesite="lax")
+                MutableHeaders(scope=message).append("set-cookie", cookie.headers["set-cookie"])
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+app.add_middleware(SessionMiddleware)
+
 class Query(BaseModel):
     user_input: str
 
+# how often a running request checks whether its client has gone away
+disconnect_poll_seconds = float(os.getenv("DISCONNECT_POLL_SECONDS", 0.5))
+
+class ClientDisconnected(Exception):
+    pass
+
+async def run_until_disconnect(request: Request, coro):
+    # run the agent as a task so it can be cancelled when the client disconnects
+    # (e.g. the Stop button aborts the fetch) instead of finishing for nobody
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=disconnect_poll_seconds)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+def busy_response(e: QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        content={"error": str(e)},
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+# answers to questions already asked, with the chart rendered for them; only the
+# first question of a conversation is cached or served from the cache, since
+# follow-ups like "and for Microsoft?" depend on what came before
+answer_cache = TTLCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 500)),
+    max_bytes=int(os.getenv("ANSWER_CACHE_MAX_BYTES", 5_000_000)),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 3600)),
+)
+
+# common question shapes are answered without the agent (see fast_path.py)
+fast_path_enabled = os.getenv("FAST_PATH", "1") == "1"
+
+async def answer_directly(session_id: str, question: str):
+    if not fast_path_enabled:
+        return None
+    with span("fast_path") as stage:
+        answer = await fast_path.fast_answer(question)
+        if stage is not None:
+            stage.attrs["answered"] = answer is not None
+    if answer:
+        await agent.record_turn(session_id, question, answer["response"])
+    return answer
+
+def normalize_question(user_input: str) -> str:
+    return " ".join(user_input.lower().split()).rstrip("?!. ")
+
+async def lookup_answer(key: str):
+    with span("answer_cache"):
+        answer_cache.sync_version(await asyncio.to_thread(agent.dataset_version.current))
+        answer = answer_cache.get(key)
+    if answer and answer["graph_url"] and not graph_store.contains(answer["graph_url"].rsplit("/", 1)[-1]):
+        # the chart was evicted from the graph store, so the cached answer is incomplete
+        answer_cache.discard(key)
+        return None
+    return answer
+
+def store_answer(key: str, response: str, graph_url):
+    if response:
+        answer_cache.put(key, {"response": response, "graph_url": graph_url}, len(response.encode()))
+
 @app.post("/api/ask")
-async def ask(query: Query):
+async def ask(query: Query, request: Request):
+    with trace_request("ask") as root:
+        return await answer_ask(query, request, root)
+
+async def answer_ask(query: Query, request: Request, root):
+    if not await wait_until_ready():
+        root.attrs["outcome"] = "unavailable"
+        return unavailable_response()
+    session_id = request.state.session_id
+    key = normalize_question(query.user_input)
+    fresh = await agent.thread_is_new(session_id)
+    if fresh and (answer := await lookup_answer(key)):
+        await agent.record_turn(session_id, query.user_input, answer["response"])
+        root.attrs["outcome"] = "cached"
+        return {**answer, "usage": context.new_usage(), "cached": True}
+    if answer := await answer_directly(session_id, query.user_input):
+        root.attrs["outcome"] = "fast_path"
+        return {**answer, "usage": context.new_usage(), "cached": False}
+
+    try:
+        with span("queue"):
+            start = await limiter.acquire()
+    except QueueFullError as e:
+        root.attrs["outcome"] = "busy"
+        return busy_response(e)
+    completed = False
+    try:
+        result = await run_until_disconnect(request, agent.aquery_agent(query.user_input, session_id))
+        completed = True
+    except ClientDisconnected:
+        # nobody is listening any more; 499 is nginx's "client closed request"
+        root.attrs["outcome"] = "disconnected"
+        return JSONResponse(status_code=499, content={"error": "client disconnected"})
+    finally:
+        limiter.release(start, completed)
+
+    if fresh:
+        store_answer(key, result["response"], result["graph_url"])
+    return {**result, "cached": False}
+
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/api/ask/stream")
+async def ask_stream(query: Query, request: Request):
+    # same as /api/ask, but as server-sent events: `token` deltas, `tool_start` and
+    # `tool_end` around every tool call, `graph` as soon as a chart is ready and
+    # a final `done` carrying the whole answer
+    # the trace is ended by whichever of the paths below finishes the request
+    root = begin_request("ask_stream")
+    try:
+        with activate(root):
+            return await start_stream(query, request, root)
+    except BaseException as e:
+        end_request(root, error=e)
+        raise
+
+async def start_stream(query: Query, request: Request, root):
+    if not await wait_until_ready():
+        root.attrs["outcome"] = "unavailable"
+        end_request(root)
+        return unavailable_response()
+    session_id = request.state.session_id
+    key = normalize_question(query.user_input)
+    fresh = await agent.thread_is_new(session_id)
+    cached = False
+    if fresh and (answer := await lookup_answer(key)):
+        await agent.record_turn(session_id, query.user_input, answer["response"])
+        cached = True
+    else:
+        answer = await answer_directly(session_id, query.user_input)
+    if answer:
+        root.attrs["outcome"] = "cached" if cached else "fast_path"
+        end_request(root)
+        async def answer_events():
+            yield sse("token", {"text": answer["response"]})
+            if answer["graph_url"]:
+                yield sse("graph", {"graph_url": answer["graph_url"]})
+            yield sse("done", {**answer, "cached": cached})
+
+        return StreamingResponse(answer_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    # admission happens before the response starts so a full queue is still a plain 429
+    try:
+        with span("queue"):
+            start = await limiter.acquire()
+    except QueueFullError as e:
+        root.attrs["outcome"] = "busy"
+        end_request(root)
+        return busy_response(e)
+
+    async def events():
+        response = ""
+        graph_url = None
+        completed = False
+        error = None
+        with activate(root):
+            try:
+                async for event in agent.astream_agent(query.user_input, session_id):
+                    name = event.pop("event")
+                    if name == "token":
+                        response += event["text"]
+                    chart_url = event.pop("graph_url", None)
+                    yield sse(name, event)
+                    if chart_url:
+                        graph_url = chart_url
+                        yield sse("graph", {"graph_url": graph_url})
+                yield sse("done", {"response": response, "graph_url": graph_url, "cached": False})
+                completed = True
+                if fresh:
+                    store_answer(key, response, graph_url)
+            except Exception as e:
+                error = e
+                yield sse("error", {"error": str(e)})
+            finally:
+                # also reached when starlette cancels the generator on client disconnect
+                limiter.release(start, completed)
+                if not completed and error is None:
+                    root.attrs["outcome"] = "disconnected"
+                end_request(root, error=error)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/stats")
+async def stats():
+    if not await wait_until_ready():
+        return unavailable_response()
+    return {"limiter": limiter.stats(), "checkpointer": agent.memory.stats(), "context": context.stats, "db_pool": database.pool_stats(agent.engine), "sql_cache": agent.sql_cache.stats(), "answer_cache": answer_cache.stats(), "graph_store": graph_store.stats(), "fast_path": fast_path.stats}
 
-    user_input = query.user_input
-    filename = f"graph_{uuid.uuid4().hex[:8]}.png"
-    full_prompt = f"If a graph is generated, save the graph as '{filename}' in the folder '{graph_folder}' and do not mention anything about the graph being saved or generated.\n{user_input}"
+# liveness: the process is up and its startup has not failed
+@app.get("/healthz")
+async def healthz():
+    if startup_task is not None and startup_task.done() and startup_task.exception():
+        return JSONResponse(status_code=503, content={"status": "failed", "error": str(startup_task.exception())})
+    return {"status": "ok"}
 
-    response = query_agent(full_prompt)
+# readiness: the agent is loaded and warmed up
+@app.get("/readyz")
+async def readyz():
+    if startup_task is None or not startup_task.done():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    if startup_task.exception():
+        return JSONResponse(status_code=503, content={"status": "failed", "error": str(startup_task.exception())})
+    if warm_up_task is not None and not warm_up_task.done():
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready"}
 
-    graph_path = os.path.join(graph_folder, filename)
-    graph_url = None
-    
-    if os.path.exists(graph_path):
-        graph_url = f"graph/{filename}"
+# request, stage and token metrics come from telemetry.py; queue and pool levels
+# are read when scraped
+Gauge("finai_queue_waiting", "Agent runs waiting for a slot").set_function(lambda: limiter.waiting)
+Gauge("finai_agent_runs_in_flight", "Agent runs holding a slot").set_function(lambda: limiter.in_flight)
+Gauge("finai_db_pool_checked_out", "Database connections in use").set_function(lambda: database.pool_stats(agent.engine).get("checked_out", 0) if agent else 0)
 
-    print(f"\n\nGRAPH URL : {graph_url}\n\n")
-    return {
-        "response": response,
-        "graph_url": graph_url
-    }
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+# charts are named by the hash of their content, so a URL always points at the same
+# image and browsers may cache it for good
+@app.get("/graph/{name}")
+async def serve_graph(name: str, request: Request):
+    etag = f'"{name}"'
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    if request.headers.get("If-None-Match") == etag and graph_store.contains(name):
+        return Response(status_code=304, headers=headers)
+    data = await asyncio.to_thread(graph_store.get, name)
+    if data is None:
+        return JSONResponse(status_code=404, content={"error": "graph not found"})
+    media_type = media_types.get(name.rsplit(".", 1)[-1], "application/octet-stream")
+    return Response(content=data, media_type=media_type, headers=headers)
 
 # Serve landing page
 @app.get("/")
@@ -0,0 +1,168 @@
+import re
+from typing import Any
+from langchain_community.tools import QuerySQLDatabaseTool
+from sqlalchemy.exc import SQLAlchemyError
+from results import to_frame
+
+# string literals and quoted identifiers are kept verbatim when normalizing SQL
+quoted = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""")
+
+
+def normalize_sql(query: str) -> str:
+    # queries differing only in whitespace or a trailing semicolon share a cache entry
+    parts = quoted.split(query.strip().rstrip(";").strip())
+    return "".join(part if i % 2 else " ".join(part.split()) for i, part in enumerate(parts))
+
+
+class QueryRejected(Exception):
+    pass
+
+
+def strip_literals(query: str) -> str:
+    # the query with string literals and quoted names blanked, for keyword checks
+    return "".join("''" if i % 2 else part for i, part in enumerate(quoted.split(query)))
+
+
+comment = re.compile(r"--[^\n]*|#[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def strip_comments(query: str) -> str:
+    # the query without the comments before its first and after its last token, so
+    # "... LIMIT 5 -- top five" still counts as limited and an appended LIMIT is not
+    # commented out; literals are masked (same length) so "--" inside them is kept
+    masked = "".join(" " * len(part) if i % 2 else part for i, part in enumerate(quoted.split(query)))
+    matches = list(comment.finditer(masked))
+    start, end = 0, len(query)
+    for match in matches:
+        if masked[start:match.start()].strip(" \t\r\n;"):
+            break
+        start = match.end()
+    for match in reversed(matches):
+        if match.start() < start or masked[match.end():end].strip(" \t\r\n;"):
+            break
+        end = match.start()
+    return query[start:end].strip().rstrip(";").strip()
+
+
+has_limit = re.compile(r"\blimit\s+\d+(\s*(,|offset)\s*\d+)?\s*$", re.IGNORECASE)
+is_select = re.compile(r"^\s*\(?\s*(select|with)\b", re.IGNORECASE)
+
+
+class QueryGuard:
+    # checks generated SELECTs before they run: a LIMIT is appended when there is
+    # none, and queries whose plan would read more than `max_scan_rows` rows are
+    # rejected with a reason the model can act on
+    def __init__(self, db, max_rows: int, max_scan_rows: int):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_scan_rows = max_scan_rows
+        self._table_rows = {}
+
+    def check(self, query: str, version):
+        # returns the query to run and whether a LIMIT was added, or raises QueryRejected
+        query = strip_comments(query.strip().rstrip(";").strip())
+        if not is_select.match(query):
+            return query, False
+        limited = not has_limit.search(strip_literals(query))
+        if limited:
+            query = f"{query}\nLIMIT {self.max_rows}"
+        estimate, scans = self.estimate_rows(query, version)
+        if estimate > self.max_scan_rows:
+            raise QueryRejected(
+                f"Error: query rejected, its plan reads about {estimate:,} rows ({scans}), more than the "
+                f"{self.max_scan_rows:,} allowed. Filter on ticker, year or industry_code, avoid joining "
+                f"company_data with itself without a key, and aggregate in the query."
+            )
+        return query, limited
+
+    def estimate_rows(self, query: str, version):
+        # rows the plan reads: per SELECT, the product of the rows of its steps
+        # (nested loops), summed over the SELECTs of the query
+        if self.db.dialect == "sqlite":
+            return self.estimate_sqlite(query, version)
+        per_select = {}
+        scans = []
+        for step in self.db._execute(f"EXPLAIN {query}", fetch="all"):
+            rows = int(step.get("rows") or 1)
+            per_select[step.get("id")] = per_select.get(step.get("id"), 1) * max(rows, 1)
+            if step.get("type") == "ALL":
+                scans.append(f"full scan of {step.get('table')}")
+        return sum(per_select.values()), ", ".join(scans) or "index lookups"
+
+    def estimate_sqlite(self, query: str, version):
+        # EXPLAIN QUERY PLAN has no row estimates; a scan counts as every row of
+        # its table (from the statistics ANALYZE keeps) and index searches as one.
+        # Steps form a tree through their parent ids: the scans directly under one
+        # node are the nested loops of one SELECT and multiply, while subqueries,
+        # compound parts and CTEs are separate nodes whose estimates add up
+        steps = self.db._execute(f"EXPLAIN QUERY PLAN {query}", fetch="all")
+        children = {}
+        for step in steps:
+            children.setdefault(step["parent"], []).append(step)
+        # CTEs and FROM subqueries are counted where they are built, not again
+        # where the outer query reads their rows
+        built = {step["detail"].split()[-1] for step in steps if step["detail"].startswith(("MATERIALIZE", "CO-ROUTINE"))}
+        scans = []
+
+        def estimate(parent):
+            loops = 1
+            nested = 0
+            correlated = 0
+            for step in children.get(parent, []):
+                match = re.match(r"SCAN (?:TABLE )?(\w+)", step["detail"])
+                if match:
+                    if match.group(1) != "CONSTANT" and match.group(1) not in built:
+                        loops *= self.table_rows(match.group(1), version)
+                        scans.append(f"full scan of {match.group(1)}")
+                elif step["id"] in children:
+                    # a correlated subquery runs once per row of the loops around it
+                    if step["detail"].startswith("CORRELATED"):
+                        correlated += estimate(step["id"])
+                    else:
+                        nested += estimate(step["id"])
+            return loops + loops * correlated + nested
+
+        return estimate(0), ", ".join(scans) or "index lookups"
+
+    def table_rows(self, table: str, version) -> int:
+        if self._table_rows.get("version") != version:
+            rows = self.db._execute("SELECT tbl, stat FROM sqlite_stat1", fetch="all")
+            self._table_rows = {"version": version, **{row["tbl"]: int(row["stat"].split()[0]) for row in rows}}
+        # the plan names tables by their alias when they have one
+        return self._table_rows.get(table) or max([v for k, v in self._table_rows.items() if k != "version"], default=1)
+
+
+class CachedQuerySQLDatabaseTool(QuerySQLDatabaseTool):
+    # QuerySQLDatabaseTool that checks each query with the QueryGuard, keeps the
+    # result rows server-side as a DataFrame in the result store and returns a
+    # preview with the result's handle. The store
+    # doubles as an LRU + TTL result cache, invalidated whenever the dataset version
+    # changes. Errors are never cached so the model can retry a rewritten query
+    description: str = (
+        "Input to this tool is a detailed and correct SQL query, output is a preview of the result "
+        "with its handle (e.g. r1a2b3c4d) and column types. Pass the handle and column names to the "
+        "chart tools instead of copying values. If the query is not correct, an error message will be "
+        "returned. If an error is returned, rewrite the query, check the query, and try again."
+    )
+    results: Any
+    dataset_version: Any
+    guard: Any
+
+    def _run(self, query: str, run_manager=None) -> str:
+        version = self.dataset_version.current()
+        self.results.frames.sync_version(version)
+        handle = self.results.handle_for(normalize_sql(query))
+        df = self.results.get(handle)
+        stored = True
+        if df is None:
+            try:
+                query, limited = self.guard.check(query, version)
+                df = to_frame(self.db._execute(query, fetch="all"))
+            except QueryRejected as e:
+                return str(e)
+            except SQLAlchemyError as e:
+                return f"Error: {e}"
+            if limited and len(df) >= self.guard.max_rows:
+                df.attrs["note"] = f"The result was cut to the first {self.guard.max_rows} rows; aggregate or filter for the rest."
+            stored = self.results.put(handle, df)
+        return self.results.preview(handle, df, stored)
@@ -4,9 +4,8 @@ const chatHistory = document.querySelector('.chat-history');
 const sendButtonIcon = sendButton.querySelector('.icon'); 
 
 let isResponding = false;
-
-const controller = new AbortController();
-const timeoutId = setTimeout(() => controller.abort(), 30000);
+// one controller per request, so the stop button can cancel the answer in flight
+let controller = null;
 
 function switchMode() {
     if (isResponding) {
@@ -42,59 +41,143 @@ async function sendMessage() {
     chatInput.value = '';
     resizeInput();
 
+    // Add an empty bot message that fills in as the answer streams back
+    const botMessageElement = document.createElement('div');
+    botMessageElement.classList.add('chat-message', 'assistant');
+    const botMessageContainer = document.createElement('div');
+    botMessageContainer.classList.add('chat-message-container');
+    botMessageContainer.appendChild(botMessageElement);
+    chatHistory.appendChild(botMessageContainer);
+    const statusElement = document.createElement('div');
+    statusElement.classList.add('chat-status');
+    botMessageContainer.appendChild(statusElement);
+
+    let botResponse = '';
+    let graphShown = false;
+    // hands the input back once the answer is complete or has failed; safe to call twice
+    let finished = false;
+    const finish = () => {
+        if (finished) return;
+        finished = true;
+        statusElement.remove();
+        controller = null;
+        switchMode();
+    };
+    const handlers = {
+        token: (data) => {
+            botResponse += data.text;
+            botMessageElement.innerHTML = botResponse.replace(/\n/g, '<br>');
+        },
+        tool_start: (data) => {
+            statusElement.textContent = toolStatus[data.tool] || `Running ${data.tool}…`;
+        },
+        tool_end: () => {
+            statusElement.textContent = '';
+        },
+        graph: (data) => {
+            addGraph(data.graph_url);
+            graphShown = true;
+        },
+        done: (data) => {
+            // the final answer is authoritative in case any delta was missed
+            botResponse = data.response;
+            botMessageElement.innerHTML = botResponse.replace(/\n/g, '<br>');
+            if (data.graph_url && !graphShown) addGraph(data.graph_url);
+            finish();
+        },
+        error: (data) => {
+            console.error('Error:', data.error);
+            botMessageElement.textContent = `Sorry, something went wrong: ${data.error}`;
+            finish();
+        },
+    };
+
     // Send user message to backend
+    controller = new AbortController();
     try {
-        const response = await fetch('/api/ask', {
+        const response = await fetch('/api/ask/stream', {
             method: 'POST',
             headers: {
             'Content-Type': 'application/json',
             },
             body: JSON.stringify({ user_input: message }),  
+            signal: controller.signal,
         });
-        if (!response.ok) throw new Error('Failed to send message');
-        // Parse JSON response from backend
-        const data = await response.json();
-        const botResponse = data.response;
-        const graphUrl = data.graph_url;
-        // Add bot's response to chat history
-        const botMessageElement = document.createElement('div');
-        botMessageElement.classList.add('chat-message', 'assistant');
-        botMessageElement.innerHTML = botResponse.replace(/\n/g, '<br>');
-        const botMessageContainer = document.createElement('div');
-        botMessageContainer.classList.add('chat-message-container');
-        botMessageContainer.appendChild(botMessageElement);
-        chatHistory.appendChild(botMessageContainer);
-        // If a graph URL exists, display the graph image
-        if (graphUrl) {
-            const graphElement = document.createElement('img');
-            graphElement.src = graphUrl;
-            graphElement.alt = "Generated Graph";
-            graphElement.classList.add('generated-graph');
-            const graphContainer = document.createElement('div');
-            graphContainer.classList.add('chat-message-container');
-            graphContainer.appendChild(graphElement);
-            chatHistory.appendChild(graphContainer);
+        if (response.status === 429) {
+            const retryAfter = response.headers.get('Retry-After');
+            botMessageElement.textContent = `Server is busy, please try again in ${retryAfter || 'a few'} seconds.`;
+            return;
         }
-
-        chatHistory.scrollTop = chatHistory.scrollHeight;
+        if (!response.ok) throw new Error('Failed to send message');
+        await readEvents(response, (event, data) => {
+            if (handlers[event]) handlers[event](data);
+            chatHistory.scrollTop = chatHistory.scrollHeight;
+        });
 
     } catch (error) {
-        console.error('Error:', error);
+        if (error.name !== 'AbortError') console.error('Error:', error);
     } finally {
-        switchMode();
+        finish();
     }
 }
 
+const toolStatus = {
+    sql_db_query: 'Querying the database…',
+    python_repl: 'Running a calculation…',
+    generate_line_plot_wrapper: 'Rendering chart…',
+    generate_multiline_plot_wrapper: 'Rendering chart…',
+    generate_bar_plot_wrapper: 'Rendering chart…',
+    generate_pie_chart_wrapper: 'Rendering chart…',
+};
+
+// Parse a text/event-stream body and call onEvent(event, data) for every frame
+async function readEvents(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of frame.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            onEvent(event, data ? JSON.parse(data) : {});
+        }
+    }
+}
+
+function addGraph(graphUrl) {
+    const graphElement = document.createElement('img');
+    graphElement.src = graphUrl;
+    graphElement.alt = "Generated Graph";
+    graphElement.classList.add('generated-graph');
+    const graphContainer = document.createElement('div');
+    graphContainer.classList.add('chat-message-container');
+    graphContainer.appendChild(graphElement);
+    chatHistory.appendChild(graphContainer);
+}
+
 sendButton.addEventListener('click', () => {
     if (!isResponding) {
         sendMessage();
+    } else if (controller) {
+        // closing the connection makes the server cancel the agent run
+        controller.abort();
     }
 });
 
 chatInput.addEventListener('keydown', function (event) {
   if (event.key === 'Enter' && !event.shiftKey) {
     event.preventDefault();
-    sendButton.click();
+    if (!isResponding) sendButton.click();
   }
 });
 
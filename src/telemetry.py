@@ -0,0 +1,189 @@
+import contextvars
+import hashlib
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import Counter, Gauge, Histogram
+
+# per-request tracing and Prometheus metrics: every request gets a trace whose
+# spans cover queueing, each model call (with token counts), each tool call and
+# each chart render. Span durations feed the stage histogram served on /metrics,
+# and traces are printed as one JSON line per request (slow ones only by default)
+
+trace_log = os.getenv("TRACE_LOG", "slow")  # all, slow or off
+trace_slow_seconds = float(os.getenv("TRACE_SLOW_SECONDS", 5))
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+request_seconds = Histogram("finai_request_seconds", "Request latency", ["endpoint", "outcome"], buckets=latency_buckets)
+requests_in_flight = Gauge("finai_requests_in_flight", "Requests being handled", ["endpoint"])
+stage_seconds = Histogram("finai_stage_seconds", "Time spent per stage of a request", ["stage"], buckets=latency_buckets)
+llm_tokens = Counter("finai_llm_tokens_total", "Model tokens", ["kind"])
+errors = Counter("finai_errors_total", "Failed stages", ["stage"])
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent=None, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+        self.offset = self.start - (parent.root_start if parent else self.start)
+        self.root_start = parent.root_start if parent else self.start
+        if parent:
+            parent.children.append(self)
+
+    def child(self, name: str, **attrs):
+        return Span(name, self, **attrs)
+
+    def finish(self, error=None):
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = str(error)[:200]
+            errors.labels(self.name).inc()
+        stage_seconds.labels(self.name).observe(self.duration)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        out = {"name": self.name, "start_ms": round(self.offset * 1000, 1), "ms": round(self.duration * 1000, 1), **self.attrs}
+        if self.error:
+            out["error"] = self.error
+        if self.children:
+            out["spans"] = [child.to_dict() for child in self.children]
+        return out
+
+
+@contextmanager
+def span(name: str, **attrs):
+    # child of the innermost open span of this request; a no-op outside requests
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, **attrs)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(error=e)
+        raise
+    else:
+        child.finish()
+    finally:
+        current_span.reset(token)
+
+
+def begin_request(endpoint: str, **attrs) -> Span:
+    # root span of a request; the handler sets root.attrs["outcome"]
+    requests_in_flight.labels(endpoint).inc()
+    return Span("request", endpoint=endpoint, **attrs)
+
+
+def end_request(root: Span, error=None):
+    root.end = time.perf_counter()
+    if error is not None:
+        root.error = str(error)[:200]
+        root.attrs.setdefault("outcome", "error")
+    endpoint = root.attrs["endpoint"]
+    requests_in_flight.labels(endpoint).dec()
+    request_seconds.labels(endpoint, root.attrs.setdefault("outcome", "ok")).observe(root.duration)
+    if trace_log == "all" or (trace_log == "slow" and root.duration >= trace_slow_seconds):
+        print(json.dumps({"trace": root.to_dict()}))
+
+
+@contextmanager
+def activate(root: Span):
+    # make `root` the parent of spans opened in this context
+    token = current_span.set(root)
+    try:
+        yield root
+    finally:
+        try:
+            current_span.reset(token)
+        except ValueError:
+            # a streamed response's generator may be closed from another context
+            pass
+
+
+@contextmanager
+def trace_request(endpoint: str, **attrs):
+    root = begin_request(endpoint, **attrs)
+    try:
+        with activate(root):
+            yield root
+    except BaseException as e:
+        end_request(root, error=e)
+        raise
+    else:
+        end_request(root)
+
+
+def request_callbacks() -> list:
+    # callbacks to pass to the agent run of the current request
+    root = current_span.get()
+    return [TraceCallbackHandler(root)] if root is not None else []
+
+
+def sql_hash(query: str) -> str:
+    return hashlib.sha1(" ".join(query.split()).encode()).hexdigest()[:12]
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    # LangChain callbacks turned into spans of one request's trace: a span per
+    # model call with its token counts and a span per tool call
+    run_inline = True
+
+    def __init__(self, root: Span):
+        self.root = root
+        self.spans = {}
+
+    def _start(self, run_id, name, **attrs):
+        self.spans[run_id] = self.root.child(name, **attrs)
+
+    def _end(self, run_id, error=None):
+        span = self.spans.pop(run_id, None)
+        if span is not None:
+            span.finish(error=error)
+        return span
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        span = self._end(run_id)
+        message = getattr(response.generations[0][0], "message", None) if response.generations and response.generations[0] else None
+        usage = getattr(message, "usage_metadata", None) or {}
+        if span is not None and usage:
+            span.attrs.update(input_tokens=usage.get("input_tokens", 0), output_tokens=usage.get("output_tokens", 0))
+        llm_tokens.labels("input").inc(usage.get("input_tokens", 0))
+        llm_tokens.labels("output").inc(usage.get("output_tokens", 0))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, inputs=None, **kwargs):
+        name = (serialized or {}).get("name") or kwargs.get("name") or "tool"
+        attrs = {}
+        if name == "sql_db_query":
+            attrs["sql_hash"] = sql_hash((inputs or {}).get("query", input_str))
+        self._start(run_id, f"tool:{name}", **attrs)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        content = str(getattr(output, "content", output))
+        error = content[:200] if content.startswith("Error") else None
+        span = self._end(run_id, error=error)
+        rows = re.match(r"Result r[0-9a-f]+: (\d+) rows", content)
+        if span is not None and rows:
+            span.attrs["rows"] = int(rows.group(1))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
@@ -0,0 +1,192 @@
+import asyncio
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# pools of worker processes for CPU-bound work kept off the server's event loop and
+# GIL (chart rendering, python_repl). Each worker is a one-process executor of its
+# own: a call first waits for an idle worker, its time limit starts once it runs,
+# and a call over the limit is stopped by killing only its worker, which is then
+# replaced, so calls running on the other workers are not affected
+
+
+class Worker:
+    def __init__(self, initializer):
+        # spawn rather than fork: the server process runs threads and an event loop
+        self.executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer,
+        )
+        # starts the process and runs the initializer before the first call
+        self.ready = self.executor.submit(int)
+        self.runs = 0
+        self.running = None
+        self.timed_out = False
+
+    def kill(self):
+        # the executor has no way to stop a call in progress
+        for process in list(self.executor._processes.values()):
+            process.kill()
+
+    def close(self, wait: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+class WorkerPool:
+    def __init__(self, workers: int, timeout: float, error: type, initializer=None, max_tasks_per_child=None,
+                 timeout_message: str = "the call took too long and was stopped",
+                 crash_message: str = "the worker process crashed, try again"):
+        # failures reach the caller as `error`: timeouts, crashed workers and any
+        # exception raised by the called function
+        self.workers = workers
+        self.timeout = timeout
+        self.error = error
+        self.initializer = initializer
+        self.max_tasks_per_child = max_tasks_per_child
+        self.timeout_message = timeout_message
+        self.crash_message = crash_message
+        self._lock = threading.RLock()
+        self._all = set()
+        self._idle = []
+        # futures of calls waiting for an idle worker, oldest first
+        self._waiting = deque()
+
+    def _start(self):
+        worker = Worker(self.initializer)
+        self._all.add(worker)
+        worker.ready.add_done_callback(lambda future: self._started(worker, future))
+
+    def _started(self, worker, future):
+        if future.cancelled() or future.exception() is not None:
+            # the process or its initializer failed: fail one waiting call rather
+            # than retry in a loop; the next call starts a new worker
+            with self._lock:
+                self._all.discard(worker)
+                worker.close()
+                while self._waiting:
+                    waiter = self._waiting.popleft()
+                    if waiter.set_running_or_notify_cancel():
+                        waiter.set_exception(self.error(self.crash_message))
+                        break
+            return
+        self._release(worker)
+
+    def _acquire(self) -> Future:
+        # a future that resolves to an idle worker, starting workers up to `workers`
+        waiter = Future()
+        with self._lock:
+            while len(self._all) < self.workers:
+                self._start()
+            if self._idle:
+                waiter.set_running_or_notify_cancel()
+                waiter.set_result(self._idle.pop())
+            else:
+                self._waiting.append(waiter)
+        return waiter
+
+    def _release(self, worker):
+        with self._lock:
+            if worker not in self._all:
+                worker.close()
+                return
+            while self._waiting:
+                waiter = self._waiting.popleft()
+                if waiter.set_running_or_notify_cancel():
+                    waiter.set_result(worker)
+                    return
+            self._idle.append(worker)
+
+    def _replace(self, worker):
+        with self._lock:
+            worker.close()
+            if worker in self._all:
+                self._all.discard(worker)
+                self._start()
+
+    def _submit(self, worker, fn, args):
+        # the time limit starts here, when an idle worker takes the call
+        worker.runs += 1
+        try:
+            future = worker.executor.submit(fn, *args)
+        except BrokenProcessPool:
+            # the worker died while idle
+            self._replace(worker)
+            raise self.error(self.crash_message)
+        worker.running = future
+        timer = threading.Timer(self.timeout, self._time_out, (worker, future))
+        timer.daemon = True
+        timer.start()
+        future.add_done_callback(lambda future: self._finished(worker, future, timer))
+        return future
+
+    def _time_out(self, worker, future):
+        with self._lock:
+            if worker.running is future and not future.done():
+                worker.timed_out = True
+                worker.kill()
+
+    def _finished(self, worker, future, timer):
+        timer.cancel()
+        with self._lock:
+            worker.running = None
+        crashed = not future.cancelled() and isinstance(future.exception(), BrokenProcessPool)
+        if crashed or (self.max_tasks_per_child and worker.runs >= self.max_tasks_per_child):
+            self._replace(worker)
+        else:
+            self._release(worker)
+
+    def _failure(self, worker, e: Exception) -> Exception:
+        if isinstance(e, self.error):
+            return e
+        if isinstance(e, BrokenProcessPool):
+            return self.error(self.timeout_message if worker.timed_out else self.crash_message)
+        return self.error(f"{type(e).__name__}: {e}")
+
+    def call(self, fn, *args):
+        worker = self._acquire().result()
+        future = self._submit(worker, fn, args)
+        try:
+            return future.result()
+        except Exception as e:
+            raise self._failure(worker, e)
+
+    async def acall(self, fn, *args):
+        waiter = self._acquire()
+        try:
+            worker = await asyncio.wrap_future(waiter)
+        except asyncio.CancelledError:
+            # the caller went away just as a worker was handed to it
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self._release(waiter.result())
+            raise
+        future = self._submit(worker, fn, args)
+        # a caller cancelled while its call runs leaves the call to finish or time out
+        try:
+            return await asyncio.wrap_future(future)
+        except Exception as e:
+            raise self._failure(worker, e)
+
+    def warm_up(self):
+        # start every worker now instead of on the first calls
+        with self._lock:
+            while len(self._all) < self.workers:
+                self._start()
+            workers = list(self._all)
+        for worker in workers:
+            worker.ready.result()
+
+    def shutdown(self, wait: bool = False):
+        # with `wait`, returns once the worker processes have exited
+        with self._lock:
+            workers = list(self._all)
+            self._all.clear()
+            self._idle.clear()
+            while self._waiting:
+                waiter = self._waiting.popleft()
+                if waiter.set_running_or_notify_cancel():
+                    waiter.set_exception(self.error("shutting down"))
+        for worker in workers:
+            worker.close(wait)